@@ -9,23 +9,40 @@
 from sys import argv
 from os import path
 from time import time
-
-ASSEMBLER_VERSION = 4
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import gc
+import glob
+import hashlib
+import io
+import json
+import os
+import pickle
+
+from fvcal_sourcemap import write_source_map
+
+ASSEMBLER_VERSION = 5
 HEADER = bytearray([0x39, 0x49, 0x36, ASSEMBLER_VERSION])
 
 
 def print_usage(code, *info):
     messages = [
-        "Usage:\n    fvcal_assembler.py <source file> <output file>",
+        "Usage:\n    fvcal_assembler.py <source file> <output file> [--incremental | -O] [-g]\n"
+        "    fvcal_assembler.py --batch <source directory or glob> <output directory> [-O] [-g]",
         "File not found:"
     ]
     print(messages[code], *info)
 
 
-def print_err(code, line, *info):
+class AssemblyError(Exception):
+    """
+        Raised when FVCAL source can not be assembled
+        Carries the error code, its type and message, and the line number it was found at
+    """
+
     types = [
-        "Syntax error\n",
-        "Value error\n"
+        "Syntax error",
+        "Value error"
     ]
 
     """
@@ -39,11 +56,25 @@ def print_err(code, line, *info):
         "Bad parameter": 0,
         "Unprefixed parameter": 0,
         "Unknown line": 1,
+        "Empty source": 1,
+        "Program too large": 1,
     }
-    errstr = list(messages.keys())[code]
+
+    def __init__(self, code, line, *info):
+        self.code = code
+        self.message = list(self.messages.keys())[code]
+        self.type = self.types[self.messages[self.message]]
+        self.line = line
+        self.info = info
+        super().__init__(code, line, *info)
+
+    def __str__(self):
+        return " ".join([self.type + ": " + self.message] + [str(i) for i in self.info] + ["at", str(self.line)])
+
+
+def print_err(error):
     print("\nCompilation error:\n")
-    print(types[messages[errstr]], errstr, *info, "at", line)
-    quit()
+    print(error.type + "\n", error.message, *error.info, "at", error.line)
 
 
 """
@@ -63,12 +94,31 @@ ops_params_bytecode = {
     "JMPEQL": [3, 0x09, 3],
     "ERR": [0, 0x0A, 0],
     "PRINT": [1, 0x03, 1],
-    "CPYBLK": [2, 0x0B, 3],
+    "CPYBLK": [3, 0x0B, 2],
+    "MOVBLK": [3, 0x0C, 2],
     "MOD": [3, 0x0D, 3],
     "DIV": [3, 0x0E, 3],
     "GOTO": [1, 0x07, 1],
     "GTNUL": [2, 0x08, 2],
-    "GTEQL": [3, 0x09, 3]
+    "GTEQL": [3, 0x09, 3],
+    "RETI": [0, 0x0F, 0],
+    "WAIT": [0, 0x10, 0],
+    "JMPFLG": [2, 0x11, 2],
+    "GTFLG": [2, 0x11, 2],
+    "VECTOR": [2, 0x03, 2],
+    "INC": [1, 0x12, 1],
+    "DEC": [1, 0x13, 1],
+    "JMPLT": [3, 0x14, 3],
+    "JMPGT": [3, 0x15, 3],
+    "DJNZ": [2, 0x16, 2],
+    "GTLSS": [3, 0x14, 3],
+    "GTGTR": [3, 0x15, 3],
+    "GTDNZ": [2, 0x16, 2],
+    "PUSH": [1, 0x17, 1],
+    "POP": [1, 0x18, 1],
+    "CALL": [1, 0x19, 1],
+    "RET": [0, 0x1A, 0],
+    "OUT": [1, 0x03, 1]
 }
 
 ops_length = {
@@ -84,20 +134,75 @@ ops_length = {
     "ERR": 0,
     "PRINT": 7,
     "CPYBLK": 7,
+    "MOVBLK": 7,
     "MOD": 9,
     "DIV": 9,
     "GOTO": 3,
     "GTNUL": 6,
-    "GTEQL": 9
+    "GTEQL": 9,
+    "RETI": 0,
+    "WAIT": 0,
+    "JMPFLG": 6,
+    "GTFLG": 6,
+    "VECTOR": 6,
+    "INC": 3,
+    "DEC": 3,
+    "JMPLT": 9,
+    "JMPGT": 9,
+    "DJNZ": 6,
+    "GTLSS": 9,
+    "GTGTR": 9,
+    "GTDNZ": 6,
+    "PUSH": 3,
+    "POP": 3,
+    "CALL": 3,
+    "RET": 0,
+    "OUT": 6
 }
 
+# Operators that jump to the line in their last param, expanding to the jump with the same opcode
+line_jump_ops = {"GOTO", "GTNUL", "GTEQL", "GTFLG", "GTLSS", "GTGTR", "GTDNZ", "CALL"}
+
 keyword_params_bytecode = {
     "OPC": bytearray([0x09, 0x00]),
     "IPT": bytearray([0x0A, 0x00]),
-    "PAL": bytearray([0x0C, 0x00]),
-    "MOD": bytearray([0x15, 0x00]),
+    "PAL": (33000).to_bytes(2, "little"),
+    "MOD": (33008).to_bytes(2, "little"),
+    "KBH": (33144).to_bytes(2, "little"),
+    "KBT": (33145).to_bytes(2, "little"),
+    "KBQ": (33146).to_bytes(2, "little"),
+    "IMK": bytearray([0x14, 0x00]),
+    "IPD": bytearray([0x15, 0x00]),
+    "IRA": bytearray([0x1A, 0x00]),
+    "TMR": bytearray([0x1C, 0x00]),
+    "FLG": bytearray([0x16, 0x00]),
+    "STK": bytearray([0x1E, 0x00]),
+    "SCR": bytearray([0x19, 0x00]),
+    "DMS": (33178).to_bytes(2, "little"),
+    "DMD": (33180).to_bytes(2, "little"),
+    "DML": (33182).to_bytes(2, "little"),
+    "DMC": (33184).to_bytes(2, "little"),
+    "DMT": (33185).to_bytes(2, "little"),
+    "BLT": (33186).to_bytes(2, "little"),
+    "BCL": (33187).to_bytes(2, "little"),
+    "BTC": (33188).to_bytes(2, "little"),
+    "BLX": (33190).to_bytes(2, "little"),
+    "BLY": (33192).to_bytes(2, "little"),
+    "BLW": (33194).to_bytes(2, "little"),
+    "BLH": (33196).to_bytes(2, "little"),
+    "BLS": (33198).to_bytes(2, "little"),
+    "SPR": (33202).to_bytes(2, "little"),
+    "CCL": (33266).to_bytes(2, "little"),
+    "CRW": (33267).to_bytes(2, "little"),
+    "CIP": (33268).to_bytes(2, "little"),
+    "CON": (33270).to_bytes(2, "little"),
+    "CST": (33271).to_bytes(2, "little"),
 }
 
+# VECTOR <interrupt> '<line> expands to a COPY of the line's address into the vector table
+INT_VECTORS = 12
+INT_COUNT = 4
+
 """
     This dictionary maps characters to their value in FVC Text Encoding
 """
@@ -170,332 +275,795 @@ FVCTE_table = {
 
 comment_char = '/'
 
+"""
+    Lookup tables used while validating and encoding parameters
+"""
+allowed_ops = set(ops_params_bytecode.keys())
+valid_prefixes = {'$', '#', '\'', '%', '^', '@', '&'}
+
+prefix_to_byte = {
+    '#': 0x00,
+    '$': 0x01,
+    '%': 0x02,
+    '^': 0x03,
+    '@': 0x04
+}
+
+# Registers are named r0 to r7, as in @r3
+register_names = {"r" + str(i) for i in range(8)}
 
-def compile_fvcal(assembly, out_path):
-    start_time = time()
-    lines = assembly.split('\n')
-    last_number = -1
-    if lines == ['']:
-        print("Source file is empty")
-        quit()
+# Indexed params add a register to their base address, as in &25000+r3
+# Their mode is 0x10 plus the number of the register
+INDEXED_MODE = 0x10
+
+
+def param_mode(param):
+    if param[0] == '&':
+        return INDEXED_MODE + int(param.split('+')[1][1:])
+
+    return prefix_to_byte[param[0]]
+
+"""
+    Writable RAM that is not mapped to any device
+    Writing a value that is already stored here has no side effects
+"""
+RAM_WRITE_BOUND = 9
+VRAM_START = 1000
+MAX_ADDRESS = 0xFFFF
+
+# Largest block a single CPYBLK or MOVBLK can copy, and so the longest PRINT string
+MAX_BLOCK_SIZE = 255
+MAX_PRINT_LENGTH = MAX_BLOCK_SIZE
+# OUT stores the length of its string in front of it, and jumps over both
+MAX_OUT_LENGTH = MAX_BLOCK_SIZE - 1
+
+
+class Instruction:
+    """
+        One tokenized line of FVCAL source
+        Every line is split only once, and both assembler passes work on these records
+    """
+    __slots__ = ("source", "number", "op", "params", "address")
+
+    def __init__(self, source, number, op, params):
+        self.source = source
+        self.number = number
+        self.op = op
+        self.params = params
+
+        # Address of the instruction in the binary, set by the layout pass
+        self.address = 0
+
+
+def tokenize_line(line):
+    s_line = line.split()
+
+    # Ignore blank and commented lines
+    if len(s_line) == 0 or s_line[0] == comment_char:
+        return None
+
+    op = s_line[1] if len(s_line) > 1 else None
+    return Instruction(line, s_line[0], op, s_line[2:])
+
+
+def tokenize(assembly):
+    instructions = []
+
+    for line in assembly.split('\n'):
+        ins = tokenize_line(line)
+        if ins is not None:
+            instructions.append(ins)
+
+    return instructions
+
+
+def data_length(ins):
+    # String literals take up address spaces before the instruction, along with the JMP over them
+    if ins.op == "PRINT" and ins.params[0][0] == '\'':
+        return ops_length["JMP"] + 1 + len(ins.params[0]) - 1
+
+    # OUT also stores the length of the string
+    if ins.op == "OUT" and ins.params[0][0] == '\'':
+        return ops_length["JMP"] + 1 + len(ins.params[0])
+
+    return 0
+
+
+def check_size(ins, address):
+    # Every address in the program has to fit in a 16-bit parameter
+    if address > MAX_ADDRESS + 1:
+        raise AssemblyError(8, ins.number)
 
-    # Parse code to make sure it's valid...
-    # ... and assemble line-address map
+
+def layout(instructions):
+    # Make sure the code is valid, set the address of each instruction...
+    # ... and assemble the line-address map
     line_address_map = {}
+    last_number = -1
     address = 32
-    for line in lines:
-        if line.strip() != '':
-            s_line = line.split()
-            number = s_line[0]
-
-            # Exempt comments from validation
-            if number == comment_char:
-                number = last_number
-                continue
 
-            op = s_line[1]
-            params = s_line[2:]
-
-            validate_line(number, op, params, last_number)
-            last_number = int(number)
-            
-            pread = address
-            # Account for string literals taking up address spaces
-            if op == "PRINT" and params[0][0] == '\'':
-                address += ops_length["JMP"] + 1
-                address += len(params[0]) - 1
-                
-            #  Helps debug the assembler
-            #print("Line:", number)
-            #print("Pre-addr:", pread)
-            #print("True addr:", address)
-            #print("Op:", op)
-            #print(' ', "len:", ops_length[op] + 1, '\n')
-            
-            line_address_map[number] = address            
-            address += ops_length[op] + 1
-    
-    #  Print the line-address map
-    #  This also helps with debugging
-    #print(line_address_map)
-    
-    # Code is valid, convert to machine code :)
-    print("Code validated, compiling...")
-    machine_code = bytearray()
-    text_location = 0
-
-    for line in lines:
-        # Ignore blank lines
-        if line.strip() == '':
-            continue
+    for ins in instructions:
+        validate_line(ins.number, ins.op, ins.params, last_number)
+        last_number = int(ins.number)
 
-        s_line = line.split()
-        # Ignore commented lines
-        if s_line[0] == '/':
-            continue
+        address += data_length(ins)
+        ins.address = address
+        line_address_map[ins.number] = address
+        address += ops_length[ins.op] + 1
+        check_size(ins, address)
 
-        # number = s_line[0]
-        op = s_line[1]
-        params = s_line[2:]
-
-        op_byte = bytearray([ops_params_bytecode[op][1]])
-
-        prefix_to_byte = {
-            '#': 0x00,
-            '$': 0x01,
-            '%': 0x02,
-            '^': 0x03
-        }
-
-        # Handle operators that must be expanded to machine code
-        # PRINT expands to JMP and CPYBLK
-        if op == "PRINT":
-            expanded_bytes = bytearray()
-            strlen = len(params[0]) - 1
-            prefix = params[0][0]
-
-            # Printing a string literal
-            if prefix == '\'':
-                # First, we insert a jump ahead
-                # This allows us to store some text data in the binary
-                expanded_bytes.append(0x07)
-                expanded_bytes.append(0x02)
-                expanded_bytes.append(strlen)
-                expanded_bytes.append(0x00)
-
-                # Store the text data
-                for i in range(strlen):
-                    current_letter = params[0][i + 1]
-                    expanded_bytes.append(FVCTE_table[current_letter])
-
-                # Insert a cpyblk to copy the text data into VRAM
-                expanded_bytes.append(0x0B)    # CPYBLK
-                expanded_bytes.append(0x00)    # Direct in
-                expanded_bytes.append(0x00)    # Direct out
-                expanded_bytes.append(strlen)  # Size
-
-                # Calculate the address where the text data is stored in the binary
-                current_address = len(machine_code) + len(expanded_bytes) + 28 - strlen
-                current_address_b = current_address.to_bytes(2, 'little')
-                expanded_bytes += current_address_b
-
-                vram_location = 0x61A8 + text_location
-                vram_location_b = vram_location.to_bytes(2, "little")
-
-                # The cpyblk instruction will write to the text portion of VRAM
-                expanded_bytes += vram_location_b
-
-            # Pointer to 16-bit int
-            elif prefix == '#':
-                strlen = 2
-                expanded_bytes.append(0x0B)  # CPYBLK opcode
-                expanded_bytes.append(0x00)
-                expanded_bytes.append(0x00)
-                expanded_bytes.append(0x02)  # 16-bit int
-
-                addr_to_print = int(params[0][1:])
-                expanded_bytes += addr_to_print.to_bytes(2, "little")
-
-                vram_location = 0x61A8 + text_location
-                vram_location_b = vram_location.to_bytes(2, "little")
-
-                # The cpyblk instruction will write to the text portion of VRAM
-                expanded_bytes += vram_location_b
-
-            machine_code += expanded_bytes
-            text_location += strlen
-
-        # GOTO instruction, expands to JMP
-        elif op == "GOTO":
-            goto_line = params[0][1:]
+    return line_address_map
 
-            try:
-                jmp_address = line_address_map[goto_line]
 
-            except KeyError:
-                print_err(6, number, goto_line)
+def text_length(ins):
+    # Number of text VRAM bytes written by a PRINT
+    if ins.op != "PRINT":
+        return 0
 
-            jmp_address_bytes = jmp_address.to_bytes(2, "little")
+    if ins.params[0][0] == '\'':
+        return len(ins.params[0]) - 1
 
-            expanded_bytes = bytearray()
-            expanded_bytes.append(0x07)  # Create JMP instruction
-            expanded_bytes.append(0x00)  # Direct mode
+    return 2
 
-            expanded_bytes += jmp_address_bytes
-            machine_code += expanded_bytes
 
-        # GTNUL instruction, expands to JMPNUL
-        elif op == "GTNUL":
-            expanded_bytes = bytearray()
+def param_bytes(param, number=None):
+    no_prefix_param = param[1:]
 
-            mode_byte = prefix_to_byte[params[0][0]]
-            addr = int(params[0][1:])
-            addr_bytes = addr.to_bytes(2, "little")
+    # Registers are encoded as their number
+    if param[0] == '@':
+        return int(no_prefix_param[1:]).to_bytes(2, "little")
 
-            goto_line = params[1][1:]
-            try:
-                jmp_address = line_address_map[goto_line]
+    # Indexed params are encoded as their base, the register is part of the mode
+    elif param[0] == '&':
+        no_prefix_param = no_prefix_param.split('+')[0]
 
-            except KeyError:
-                print_err(6, number, goto_line)
+    # Handle conversion of keyword params to numbers
+    if no_prefix_param in keyword_params_bytecode:
+        return keyword_params_bytecode[no_prefix_param]
 
-            jmp_address_bytes = jmp_address.to_bytes(2, "little")
+    # Handle conversion of normal params to numbers
+    if not is_word(no_prefix_param):
+        raise AssemblyError(4, number, param)
+    return int(no_prefix_param).to_bytes(2, "little")
 
-            expanded_bytes.append(0x08)
-            expanded_bytes.append(0x00)
-            expanded_bytes.append(mode_byte)
-            expanded_bytes += jmp_address_bytes
-            expanded_bytes += addr_bytes
 
-            machine_code += expanded_bytes
+def target_bytes(ins, param, line_address_map):
+    goto_line = param[1:]
 
-        # GTEQL instruction, expands to JMPEQL
-        elif op == "GTEQL":
-            expanded_bytes = bytearray()
+    try:
+        jmp_address = line_address_map[goto_line]
 
-            mode_byte1 = prefix_to_byte[params[0][0]]
-            mode_byte2 = prefix_to_byte[params[1][0]]
-            addr1 = int(params[0][1:])
-            addr2 = int(params[1][1:])
-            addr1_bytes = addr1.to_bytes(2, "little")
-            addr2_bytes = addr2.to_bytes(2, "little")
-            goto_line = params[2][1:]
+    except KeyError:
+        raise AssemblyError(6, ins.number, goto_line)
 
-            try:
-                jmp_address = line_address_map[goto_line]
+    return jmp_address.to_bytes(2, "little")
+
+
+def encode(ins, line_address_map, text_location):
+    # Convert one instruction into machine code
+    op = ins.op
+    params = ins.params
 
-            except KeyError:
-                print_err(6, number, goto_line)
+    # Handle operators that must be expanded to machine code
+    # PRINT expands to JMP and CPYBLK
+    if op == "PRINT":
+        expanded_bytes = bytearray()
+        vram_location = 0x61A8 + text_location
+        vram_location_b = vram_location.to_bytes(2, "little")
 
-            jmp_address_bytes = jmp_address.to_bytes(2, "little")
+        # Printing a string literal
+        if params[0][0] == '\'':
+            text = params[0][1:]
+            strlen = len(text)
 
-            expanded_bytes.append(0x09)
-            expanded_bytes.append(0x00)
-            expanded_bytes.append(mode_byte1)
-            expanded_bytes.append(mode_byte2)
-            expanded_bytes += jmp_address_bytes
-            expanded_bytes += addr1_bytes
-            expanded_bytes += addr2_bytes
+            # First, we insert a jump ahead
+            # This allows us to store some text data in the binary
+            expanded_bytes += bytes([0x07, 0x02, strlen, 0x00])
 
-            machine_code += expanded_bytes
+            # Store the text data
+            expanded_bytes += bytes(FVCTE_table[c] for c in text)
 
-        # Handle all other operators
+            # Insert a cpyblk to copy the text data into VRAM
+            expanded_bytes += bytes([0x0B, 0x00, 0x00, strlen])  # CPYBLK, direct in, direct out, size
+
+            # The text data is stored right before the cpyblk instruction
+            current_address = ins.address - strlen
+            expanded_bytes += current_address.to_bytes(2, 'little')
+
+        # Pointer to 16-bit int
         else:
-            # Determine modes from prefixes
-            mode_count = ops_params_bytecode[op][2]
-            mode_prefixes = []
-            for mode_param_i in range(mode_count):
-                mode_prefixes.append(params[mode_param_i][0])
+            expanded_bytes += bytes([0x0B, 0x00, 0x00, 0x02])  # CPYBLK, direct in, direct out, 16-bit int
+
+            addr_to_print = param_value(params[0], ins.number)
+            expanded_bytes += addr_to_print.to_bytes(2, "little")
+
+        # The cpyblk instruction will write to the text portion of VRAM
+        expanded_bytes += vram_location_b
+
+        return expanded_bytes
+
+    # Line jumps expand to the jump sharing their opcode, such as GOTO to JMP and GTDNZ to DJNZ
+    # The jump is absolute, and its target comes before the other params, just like their modes
+    elif op in line_jump_ops:
+        return (bytes([ops_params_bytecode[op][1], 0x00] + [param_mode(p) for p in params[:-1]]) +
+                target_bytes(ins, params[-1], line_address_map) +
+                b''.join(param_bytes(p, ins.number) for p in params[:-1]))
+
+    # CPYBLK and MOVBLK take a one-byte size, then the source and destination addresses
+    # A '#' address is used as is, and a '$' address holds the address to use
+    elif op == "CPYBLK" or op == "MOVBLK":
+        return (bytes([ops_params_bytecode[op][1], param_mode(params[1]), param_mode(params[2]),
+                       param_value(params[0], ins.number)]) +
+                param_bytes(params[1], ins.number) + param_bytes(params[2], ins.number))
+
+    # OUT instruction, expands to a COPY of a value to the console port, or for a string, a JMP over
+    # the string and its length, then a COPY of their address to the console string register
+    elif op == "OUT":
+        if params[0][0] == '\'':
+            text = params[0][1:]
+            data = bytes([len(text)]) + bytes(FVCTE_table[c] for c in text)
+            return (bytes([0x07, 0x02, len(data), 0x00]) + data + bytes([0x03, 0x00, 0x00]) +
+                    (ins.address - len(data)).to_bytes(2, "little") + keyword_params_bytecode["CST"])
+
+        return (bytes([0x03, param_mode(params[0]), 0x00]) + param_bytes(params[0], ins.number) +
+                keyword_params_bytecode["CON"])
+
+    # VECTOR instruction, expands to COPY
+    elif op == "VECTOR":
+        vector = INT_VECTORS + 2 * param_value(params[0], ins.number)
+        return bytes([0x03, 0x00, 0x00]) + target_bytes(ins, params[1], line_address_map) + vector.to_bytes(2, "little")
+
+    # Handle all other operators
+    # Parameter modes are inferred from their prefixes, and come before the parameters themselves
+    op_bytecode = ops_params_bytecode[op]
+    instruction_bytes = bytearray([op_bytecode[1]])
+    for mode_param_i in range(op_bytecode[2]):
+        instruction_bytes.append(param_mode(params[mode_param_i]))
+
+    for param in params:
+        instruction_bytes += param_bytes(param, ins.number)
+
+    return instruction_bytes
+
+
+def dependencies(ins, line_address_map, text_location):
+    # Everything besides the instruction itself that its machine code depends on
+    op = ins.op
+
+    if op == "PRINT":
+        if ins.params[0][0] == '\'':
+            return ins.address, text_location
+        return text_location,
+
+    elif op == "OUT" and ins.params[0][0] == '\'':
+        return ins.address,
+
+    elif op in line_jump_ops or op == "VECTOR":
+        return line_address_map.get(ins.params[-1][1:]),
+
+    return ()
+
+
+class ObjectCache:
+    """
+        Per-line object cache for incremental assembly
+        Maps each source line to its instruction record and machine code, along with the addresses
+        the machine code was encoded against.
+        When reassembling, only new lines are tokenized and validated. A line is only encoded again if
+        it is new, or if it is a PRINT, OUT, line jump or VECTOR whose address, text location or target moved
+    """
+
+    def __init__(self):
+        # Source line -> [instruction, dependencies, machine code]
+        self.objects = {}
+        self.instructions = []
+        self.line_address_map = {}
+        self.reused = 0
+
+    def assemble(self, assembly):
+        objects = {}
+        entries = []
+        line_address_map = {}
+        last_number = -1
+        address = 32
+
+        for line in assembly.split('\n'):
+            entry = self.objects.get(line)
+
+            if entry is None:
+                ins = tokenize_line(line)
+                if ins is None:
+                    continue
+
+                validate_line(ins.number, ins.op, ins.params, last_number)
+                entry = [ins, None, None]
+
+            else:
+                # Only the line order can have changed
+                ins = entry[0]
+                if int(ins.number) <= last_number:
+                    raise AssemblyError(1, ins.number)
+
+            last_number = int(ins.number)
+            address += data_length(ins)
+            ins.address = address
+            line_address_map[ins.number] = address
+            address += ops_length[ins.op] + 1
+            check_size(ins, address)
+
+            # Lines that were removed from the source are dropped from the cache
+            objects[line] = entry
+            entries.append(entry)
+
+        machine_code = bytearray()
+        text_location = 0
+        self.reused = 0
+
+        for entry in entries:
+            ins = entry[0]
+            deps = dependencies(ins, line_address_map, text_location)
+
+            if entry[2] is not None and entry[1] == deps:
+                self.reused += 1
+            else:
+                # Encode before updating the entry, so a failed build leaves the cache consistent
+                entry[2] = bytes(encode(ins, line_address_map, text_location))
+                entry[1] = deps
+
+            machine_code += entry[2]
+            text_location += text_length(ins)
+
+        self.objects = objects
+        self.instructions = [entry[0] for entry in entries]
+        self.line_address_map = line_address_map
+
+        return machine_code
+
+
+def tables_digest():
+    # Hash of the assembler version and of the tables machine code is encoded with
+    # Anything assembled or cached under a different digest is assembled again
+    tables = (ASSEMBLER_VERSION, ops_params_bytecode, ops_length, keyword_params_bytecode, FVCTE_table,
+              INT_VECTORS, MAX_BLOCK_SIZE)
+    return hashlib.sha256(repr(tables).encode()).hexdigest()
+
+
+def load_cache(cache_path):
+    cache = ObjectCache()
+
+    if path.isfile(cache_path):
+        cache_file = open(cache_path, 'rb')
+        stored = pickle.load(cache_file)
+        cache_file.close()
+
+        # Caches written by another version of the assembler, or without a digest, are thrown away
+        if type(stored) != tuple or stored[0] != tables_digest():
+            return cache
 
-            # Assemble list of 8-bit modes
-            modes = [prefix_to_byte[p] for p in mode_prefixes]
+        # Only plain data is stored, so the lines are tokenized again, but not validated
+        for line, (deps, machine_code) in stored[1].items():
+            cache.objects[line] = [tokenize_line(line), deps, machine_code]
 
-            # Assemble parameters with their respective modes into bytes
-            param_bytes = bytearray()
-            modes_inserted = 0
+    return cache
 
-            # First, insert the parameter mode arguments
-            for param in params:
-                while modes_inserted < mode_count:
-                    param_bytes.append(modes[modes_inserted])
-                    modes_inserted += 1
 
-                no_prefix_param = param[1:]
+def save_cache(cache, cache_path):
+    objects = {line: (entry[1], entry[2]) for line, entry in cache.objects.items()}
 
-                # Handle conversion of keyword params to numbers
-                if no_prefix_param in list(keyword_params_bytecode.keys()):
-                    no_prefix_param = keyword_params_bytecode[no_prefix_param]
+    cache_file = open(cache_path, 'wb')
+    pickle.dump((tables_digest(), objects), cache_file, pickle.HIGHEST_PROTOCOL)
+    cache_file.close()
 
-                # Handle conversion of normal params to numbers
-                else:
-                    no_prefix_param = int(no_prefix_param)
-                    no_prefix_param = no_prefix_param.to_bytes(2, "little")
 
-                param_bytes += no_prefix_param
+def param_value(param, number=None):
+    return int.from_bytes(param_bytes(param, number), "little")
 
-            # Store the assembled machine code
-            instruction_bytes = op_byte + param_bytes
-            machine_code += instruction_bytes
+
+def is_noop(ins):
+    # COPY of a plain RAM address onto itself
+    # ADD #0 is not a no-op, since it sets the flags
+    if ins.op != "COPY":
+        return False
+
+    source, out = ins.params
+
+    if source[0] != '$' or out[0] != '#':
+        return False
+
+    addr = param_value(out)
+    return param_value(source) == addr and RAM_WRITE_BOUND <= addr < VRAM_START
+
+
+def is_string_print(ins):
+    return ins.op == "PRINT" and ins.params[0][0] == '\''
+
+
+def jump_targets(ins):
+    # Indices of the params holding line targets
+    if ins.op in line_jump_ops or ins.op == "VECTOR":
+        return [len(ins.params) - 1]
+
+    return []
+
+
+def optimize(instructions):
+    """
+        Peephole optimizer, enabled with -O
+        Works on validated instruction records before emission:
+            - self-COPYs of plain RAM are dropped
+            - adjacent string PRINTs are merged into one, so they become a single CPYBLK
+            - jumps to a GOTO go straight to its target instead
+        Returns the optimized records, and a map of removed line numbers to the line that took their address
+    """
+    targets = set()
+    for ins in instructions:
+        for i in jump_targets(ins):
+            targets.add(ins.params[i][1:])
+
+    optimized = []
+    aliases = {}
+    removed = []
+
+    for ins in instructions:
+        if is_noop(ins):
+            removed.append(ins)
+            continue
+
+        # Merging is only safe if nothing jumps between the two PRINTs
+        if (len(optimized) > 0 and is_string_print(ins) and is_string_print(optimized[-1]) and
+                ins.number not in targets and all(r.number not in targets for r in removed) and
+                len(optimized[-1].params[0]) + len(ins.params[0]) - 2 <= MAX_PRINT_LENGTH):
+            last = optimized[-1]
+            text = last.params[0] + ins.params[0][1:]
+            optimized[-1] = Instruction(last.number + " PRINT " + text, last.number, "PRINT", [text])
+            removed.append(ins)
+            for r in removed:
+                aliases[r.number] = last.number
+            removed = []
+            continue
+
+        # Removed lines now start at the next instruction
+        for r in removed:
+            aliases[r.number] = ins.number
+        removed = []
+        optimized.append(ins)
+
+    # Trailing no-ops have no next instruction to take their address, so they stay
+    optimized += removed
+
+    # Fold jumps to jumps
+    by_number = {ins.number: ins for ins in optimized}
+    for index in range(len(optimized)):
+        ins = optimized[index]
+        params = list(ins.params)
+
+        for i in jump_targets(ins):
+            target = aliases.get(params[i][1:], params[i][1:])
+            seen = {target}
+            while target in by_number and by_number[target].op == "GOTO":
+                target = by_number[target].params[0][1:]
+                target = aliases.get(target, target)
+                if target in seen:
+                    break
+                seen.add(target)
+
+            params[i] = '\'' + target
+
+        if params != ins.params:
+            source = ins.number + " " + ins.op + " " + " ".join(params)
+            optimized[index] = Instruction(source, ins.number, ins.op, params)
+
+    return optimized, aliases
+
+
+def source_ranges(instructions):
+    # Address ranges of every instruction, and of each part of the expanded ones
+    expansions = {"GOTO": "JMP", "GTNUL": "JMPNUL", "GTEQL": "JMPEQL", "GTFLG": "JMPFLG",
+                  "GTLSS": "JMPLT", "GTGTR": "JMPGT", "GTDNZ": "DJNZ", "VECTOR": "COPY", "OUT": "COPY",
+                  "PRINT": "CPYBLK"}
+    ranges = []
+
+    for ins in instructions:
+        number = int(ins.number)
+        end = ins.address + ops_length[ins.op] + 1
+
+        # PRINT and OUT of a string start with a JMP over their text data
+        data = data_length(ins)
+        if data > 0:
+            data_start = ins.address - data + ops_length["JMP"] + 1
+            ranges.append((ins.address - data, data_start, number, ins.op, "JMP"))
+            if data_start < ins.address:
+                ranges.append((data_start, ins.address, number, ins.op, "DATA"))
+
+        ranges.append((ins.address, end, number, ins.op, expansions.get(ins.op, ins.op)))
+
+    return ranges
+
+
+def assemble(assembly, cache=None, optimization=False, source_map=False):
+    """
+        Assembles FVCAL source in memory
+        Returns the binary, header included, along with a dictionary of diagnostics:
+            lines       number of assembled lines
+            removed     lines removed by the optimizer
+            reused      lines reused from the object cache
+            elapsed     seconds taken
+            source_map  (start, end, line number, op, part) ranges, if source_map is set
+        Raises AssemblyError if the source is invalid
+        The optimizer rewrites lines, so it can not be used with an object cache, and passing both
+        raises ValueError
+    """
+    start_time = time()
+    if cache is not None and optimization:
+        raise ValueError("optimization can not be used with an object cache")
+    if assembly == '':
+        raise AssemblyError(7, 0)
+
+    diagnostics = {"removed": 0, "reused": 0}
+
+    # Incremental assembly validates and emits in one go
+    if cache is not None:
+        machine_code = cache.assemble(assembly)
+        instructions = cache.instructions
+        diagnostics["reused"] = cache.reused
+
+    else:
+        instructions = tokenize(assembly)
+        line_address_map = layout(instructions)
+
+        # Lay out the optimized code again, with removed lines sharing the address of their replacement
+        if optimization:
+            line_count = len(instructions)
+            instructions, aliases = optimize(instructions)
+            line_address_map = layout(instructions)
+            for number, replacement in aliases.items():
+                line_address_map[number] = line_address_map[replacement]
+            diagnostics["removed"] = line_count - len(instructions)
+
+        # Code is valid, convert to machine code :)
+        machine_code = bytearray()
+        text_location = 0
+
+        for ins in instructions:
+            machine_code += encode(ins, line_address_map, text_location)
+            text_location += text_length(ins)
+
+    diagnostics["lines"] = len(instructions)
+    if source_map:
+        diagnostics["source_map"] = source_ranges(instructions)
+    diagnostics["elapsed"] = time() - start_time
+
+    return bytes(HEADER + machine_code), diagnostics
+
+
+def compile_fvcal(assembly, out_path, cache=None, optimization=False, source_map=False):
+    # Assemble to a file, raising AssemblyError if the source is invalid
+    assembled_program, diagnostics = assemble(assembly, cache, optimization, source_map)
+
+    if cache is not None:
+        print("Reused", diagnostics["reused"], "of", diagnostics["lines"], "lines")
+    if optimization:
+        print("Optimizer removed", diagnostics["removed"], "of", diagnostics["lines"] + diagnostics["removed"],
+              "lines")
 
     # Write the assembled binary to disk
-    assembled_program = HEADER + machine_code
     out_file = open(out_path, 'wb')
     out_file.write(assembled_program)
     out_file.close()
 
-    end_time = time()
-    elapsed = round(end_time - start_time, 3)
+    # The source map is written next to the binary
+    if source_map:
+        write_source_map(out_path + ".map", diagnostics["source_map"])
 
-    # print(*assembled_program)
-    print("Compilation finished in", elapsed, "seconds")
+    print("Compilation finished in", round(diagnostics["elapsed"], 3), "seconds")
 
 
-def validate_line(number, op, params, last_number):
-    allowed_ops = list(ops_params_bytecode.keys())
-    valid_prefixes = ['$', '#', '\'', '%', '^']
+def assemble_file(in_path, out_path, optimization, source_map):
+    # Runs in a batch worker process
+    # Returns the size of the binary, the time taken and any error message
+    start_time = time()
+
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            compile_fvcal(open(in_path, 'r').read(), out_path, optimization=optimization, source_map=source_map)
+
+    except AssemblyError as error:
+        return 0, time() - start_time, str(error)
+
+    return path.getsize(out_path), time() - start_time, None
+
+
+def compile_batch(pattern, out_dir, optimization=False, source_map=False):
+    # Sources can be given as a directory of .txt files, or as a glob
+    if path.isdir(pattern):
+        pattern = path.join(pattern, "*.txt")
+    in_paths = sorted(glob.glob(pattern))
+
+    if not path.isdir(out_dir):
+        os.makedirs(out_dir)
 
+    # The manifest remembers the hash of every source that was assembled into out_dir
+    manifest_path = path.join(out_dir, "fvcal_manifest.json")
+    manifest = {}
+    if path.isfile(manifest_path):
+        manifest = json.load(open(manifest_path, 'r'))
+
+    options = tables_digest() + ("O" if optimization else "") + ("g" if source_map else "")
+    jobs = {}
+    results = {}
+    for in_path in in_paths:
+        name = path.splitext(path.basename(in_path))[0]
+        out_path = path.join(out_dir, name + ".vce")
+        digest = hashlib.sha256(open(in_path, 'rb').read() + options.encode()).hexdigest()
+
+        # Skip sources that have not changed since they were last assembled
+        if manifest.get(in_path) == digest and path.isfile(out_path):
+            results[in_path] = ("skipped", path.getsize(out_path), 0, None)
+        else:
+            jobs[in_path] = (out_path, digest)
+
+    start_time = time()
+    # The workers only assemble, so like the command line, they run without the cyclic garbage collector
+    with ProcessPoolExecutor(initializer=gc.disable) as pool:
+        futures = {in_path: pool.submit(assemble_file, in_path, out_path, optimization, source_map)
+                   for in_path, (out_path, digest) in jobs.items()}
+
+        for in_path, future in futures.items():
+            # A source that crashes the assembler only fails itself, not the rest of the batch
+            try:
+                size, elapsed, error = future.result()
+
+            except Exception as exception:
+                size, elapsed, error = 0, 0, type(exception).__name__ + ": " + str(exception)
+
+            if error is None:
+                manifest[in_path] = jobs[in_path][1]
+                results[in_path] = ("built", size, elapsed, None)
+            else:
+                manifest.pop(in_path, None)
+                results[in_path] = ("failed", size, elapsed, error)
+
+    manifest_file = open(manifest_path, 'w')
+    json.dump(manifest, manifest_file, indent=4, sort_keys=True)
+    manifest_file.close()
+
+    # Summary table
+    print("%-40s %-8s %10s %10s" % ("Source", "Status", "Bytes", "Seconds"))
+    for in_path in in_paths:
+        status, size, elapsed, error = results[in_path]
+        print("%-40s %-8s %10d %10.3f" % (in_path, status, size, elapsed))
+        if error is not None:
+            print("    " + error)
+
+    failed = sum(1 for r in results.values() if r[0] == "failed")
+    print("\n" + str(len(jobs) - failed), "built,", len(in_paths) - len(jobs), "skipped,", failed, "failed in",
+          round(time() - start_time, 3), "seconds")
+
+    return 1 if failed > 0 else 0
+
+
+def is_word(text):
+    # Whether text is a number that fits in a 16-bit parameter
+    try:
+        return 0 <= int(text) <= 0xFFFF
+
+    except ValueError:
+        return False
+
+
+def validate_line(number, op, params, last_number):
     # Make sure line number is valid
     try:
-        int(number)
         assert (int(number) > last_number)
 
     except ValueError:
-        print_err(0, number)
+        raise AssemblyError(0, number)
 
     except AssertionError:
-        print_err(1, number)
+        raise AssemblyError(1, number)
 
     # Make sure operator is valid
-    try:
-        assert (op in allowed_ops)
-
-    except AssertionError:
-        print_err(2, number, op)
+    if op not in allowed_ops:
+        raise AssemblyError(2, number, op)
 
     # Make sure correct number of parameters is used
-    try:
-        assert (ops_params_bytecode[op][0] == len(params))
-    except AssertionError:
-        print_err(3, number)
+    if ops_params_bytecode[op][0] != len(params):
+        raise AssemblyError(3, number)
 
     # Make sure each parameter is valid
-    for param in params:
+    for i in range(len(params)):
+        param = params[i]
         prefix = param[0]
-        prefixed = prefix in valid_prefixes
 
-        # Good, the param has a prefix
-        if prefixed:
-            # Is the param a string?
-            if prefix == '\'':
-                pass
+        # The param is invalid because it does not have a prefix
+        if prefix not in valid_prefixes:
+            raise AssemblyError(5, number, param)
 
-            # Is the param a number/address?
-            else:
-                try:
-                    int(param[1:])
+        # Is the param a string or line? Lines are only the targets of line jumps and VECTOR,
+        # and strings are only printed by PRINT and OUT
+        elif prefix == '\'':
+            if (op in line_jump_ops or op == "VECTOR") and i == len(params) - 1:
+                continue
 
-                except ValueError:
-                    # The param is not a string, number, or address
-                    # Is it an address keyword?
-                    try:
-                        assert (param[1:] in list(keyword_params_bytecode.keys()))
-
-                    except AssertionError:
-                        # The param is invalid because it is not a string, number, address, or address keyword
-                        print_err(4, number, param)
-
-        # The param is invalid because it does not have a prefix
-        else:
-            print_err(5, number, param)
+            if op != "PRINT" and op != "OUT":
+                raise AssemblyError(4, number, param)
+
+            # Every character must exist in FVCTE, and PRINT and OUT store the string as a single block
+            for c in param[1:]:
+                if c not in FVCTE_table:
+                    raise AssemblyError(4, number, param)
+            if op == "PRINT" and len(param) - 1 > MAX_PRINT_LENGTH:
+                raise AssemblyError(4, number, param)
+            if op == "OUT" and len(param) - 1 > MAX_OUT_LENGTH:
+                raise AssemblyError(4, number, param)
+
+        # Line jumps and VECTOR only jump to lines
+        elif (op in line_jump_ops or op == "VECTOR") and i == len(params) - 1:
+            raise AssemblyError(4, number, param)
+
+        # Is the param a register? PRINT only takes addresses
+        elif prefix == '@':
+            if param[1:] not in register_names or op == "PRINT":
+                raise AssemblyError(4, number, param)
+
+        # Is the param a base address plus an index register?
+        elif prefix == '&':
+            parts = param[1:].split('+')
+            if len(parts) != 2 or parts[1] not in register_names or op == "PRINT":
+                raise AssemblyError(4, number, param)
+
+            if parts[0] not in keyword_params_bytecode and not is_word(parts[0]):
+                raise AssemblyError(4, number, param)
+
+        # PRINT takes a numeric address, which is encoded as it is
+        elif op == "PRINT":
+            if prefix not in ('#', '$') or not is_word(param[1:]):
+                raise AssemblyError(4, number, param)
+
+        # Is the param a number/address, or an address keyword?
+        # The param is invalid if it is not a string, 16-bit number, address, or address keyword
+        elif param[1:] not in keyword_params_bytecode and not is_word(param[1:]):
+            raise AssemblyError(4, number, param)
+
+    # Block sizes are a single literal byte
+    if op == "CPYBLK" or op == "MOVBLK":
+        if params[0][0] != '#' or param_value(params[0], number) > MAX_BLOCK_SIZE:
+            raise AssemblyError(4, number, params[0])
+        for param in params[1:]:
+            if param[0] not in ('#', '$', '@', '&'):
+                raise AssemblyError(4, number, param)
+
+    # OUT prints at least one character
+    if op == "OUT" and params[0] == '\'':
+        raise AssemblyError(4, number, params[0])
+
+    # VECTOR takes the number of an interrupt, followed by the line of its handler
+    if op == "VECTOR":
+        if params[0][0] != '#' or param_value(params[0], number) >= INT_COUNT:
+            raise AssemblyError(4, number, params[0])
+        if params[1][0] != '\'':
+            raise AssemblyError(4, number, params[1])
 
 
 def get_input(args):
-    if len(args) != 3:
+    flags = [a for a in args[1:] if a.startswith('-')]
+    paths = [a for a in args[1:] if not a.startswith('-')]
+
+    # The optimizer rewrites lines, so it does not work with the per-line object cache
+    incremental = "-i" in flags or "--incremental" in flags
+    optimization = "-O" in flags
+    source_map = "-g" in flags
+    batch = "--batch" in flags
+    if (len(paths) != 2 or len(flags) != incremental + optimization + source_map + batch or
+            (incremental and optimization) or (incremental and batch)):
         print_usage(0)
         return 1
 
-    in_path = args[1]
-    out_path = args[2]
+    in_path = paths[0]
+    out_path = paths[1]
+
+    if batch:
+        return compile_batch(in_path, out_path, optimization, source_map)
 
     if not path.isfile(in_path):
         print_usage(1, in_path)
@@ -505,8 +1073,26 @@ def get_input(args):
     assembly = open(in_path, 'r').read()
     print("\nCompiling", in_path, "to", out_path)
     print("------------------------------------")
-    compile_fvcal(assembly, out_path)
+
+    # Instruction records never form reference cycles, so the cyclic garbage collector would only
+    # spend time rescanning them on large programs. This process only assembles, so it stays off
+    gc.disable()
+
+    # Incremental builds keep their object cache next to the output
+    try:
+        if incremental:
+            cache_path = out_path + ".cache"
+            cache = load_cache(cache_path)
+            compile_fvcal(assembly, out_path, cache, source_map=source_map)
+            save_cache(cache, cache_path)
+
+        else:
+            compile_fvcal(assembly, out_path, optimization=optimization, source_map=source_map)
+
+    except AssemblyError as error:
+        print_err(error)
+        return 1
 
 
 if __name__ == '__main__':
-    get_input(argv)
+    exit(get_input(argv))
@@ -0,0 +1,327 @@
+"""
+    Synthetic workload generator for Fun Virtual Computer Assembly Language
+    Emits valid FVCAL programs of any size for assembler and processor scaling tests
+
+    Usage:
+        fvcal_generator.py <output file> [--lines <n>] [--mix <mix>] [--seed <n>] [--expected <file>]
+
+    Programs are built from randomly chosen blocks (arithmetic, forward branches, PRINTs and
+    GOTO/GTEQL counted loops), and the same seed always produces the same program.
+    A reference model runs every generated program, so its expected final variables, text VRAM
+    and instruction count are known without needing the virtual computer.
+"""
+
+import argparse
+import json
+import random
+
+from fvcal_assembler import ops_length, FVCTE_table
+
+'''
+    Data layout
+    Loop counters and variables live at the bottom of graphics VRAM, far from the program.
+    Variables are two bytes wide, the width of every arithmetic result
+'''
+COUNTER_BASE = 24880
+COUNTERS = [COUNTER_BASE, COUNTER_BASE + 2]
+VAR_BASE = 24888
+VARIABLES = [VAR_BASE + 2 * i for i in range(8)]
+TEXT_BASE = 0x61A8
+
+# Branch targets and PRINT data addresses are 16 bits, and only 4000 characters of text are displayed
+MAX_ADDRESS = 0xFFFF
+MAX_TEXT = 4000
+
+# Block weights of each instruction mix
+mixes = {
+    "arith": {"arith": 1},
+    "branch": {"arith": 3, "branch": 7},
+    "print": {"arith": 2, "print": 8},
+    "loop": {"arith": 2, "loop": 8},
+    "mixed": {"arith": 1, "branch": 1, "print": 1, "loop": 1},
+}
+
+printable = [c for c in FVCTE_table if FVCTE_table[c] >= 0x10]
+
+
+class Generator:
+    def __init__(self, line_count, mix, seed):
+        self.rng = random.Random(seed)
+        self.line_count = line_count
+        self.weights = mixes[mix]
+        self.lines = []
+        self.address = 32
+        self.text_location = 0
+
+    def emit(self, op, *params):
+        self.lines.append((len(self.lines) * 10, op, list(params)))
+
+        if op == "PRINT" and params[0][0] == '\'':
+            self.address += ops_length["JMP"] + 1 + len(params[0]) - 1
+            self.text_location += len(params[0]) - 1
+        elif op == "PRINT":
+            self.text_location += 2
+        self.address += ops_length[op] + 1
+
+    def next_number(self, offset):
+        # The line number of a line that has not been emitted yet
+        return "'" + str((len(self.lines) + offset) * 10)
+
+    def variable(self):
+        return '$' + str(self.rng.choice(VARIABLES))
+
+    def arith_block(self):
+        rng = self.rng
+        out = '#' + str(rng.choice(VARIABLES))
+        op = rng.choice(["ADD", "MULT", "MOD", "DIV", "COPY"])
+
+        if op == "COPY":
+            source = self.variable() if rng.random() < 0.5 else '#' + str(rng.randint(0, 999))
+            self.emit(op, source, out)
+
+        # Never divide by a variable, it could be zero
+        elif op in ("MOD", "DIV"):
+            self.emit(op, self.variable(), '#' + str(rng.randint(1, 251)), out)
+
+        else:
+            second = self.variable() if rng.random() < 0.5 else '#' + str(rng.randint(0, 99))
+            self.emit(op, self.variable(), second, out)
+
+    def branch_block(self, remaining):
+        # Skip a few arithmetic lines if a condition holds
+        skipped = self.rng.randint(1, min(3, remaining - 1))
+        target = self.next_number(1 + skipped)
+
+        kind = self.rng.randint(0, 3)
+        if kind == 0:
+            self.emit("GTEQL", self.variable(), '#' + str(self.rng.randint(0, 255)), target)
+        elif kind == 1:
+            self.emit("GTNUL", self.variable(), target)
+        elif kind == 2:
+            self.emit("GTFLG", '#' + str(self.rng.randint(1, 7)), target)
+        else:
+            self.emit("GOTO", target)
+
+        for i in range(skipped):
+            self.arith_block()
+
+    def print_block(self):
+        if self.rng.random() < 0.7:
+            word = ''.join(self.rng.choice(printable) for i in range(self.rng.randint(1, 12)))
+            self.emit("PRINT", '\'' + word)
+        else:
+            self.emit("PRINT", '#' + str(self.rng.choice(VARIABLES)))
+
+    def loop_block(self, remaining):
+        # A counted loop takes 4 lines on top of its body
+        body = self.rng.randint(1, min(3, remaining - 4))
+        counter = self.rng.choice(COUNTERS)
+        iterations = self.rng.randint(2, 20)
+
+        self.emit("COPY", "#0", '#' + str(counter))
+        head = self.next_number(0)
+        for i in range(body):
+            self.arith_block()
+
+        self.emit("ADD", "#1", '$' + str(counter), '#' + str(counter))
+        self.emit("GTEQL", '$' + str(counter), '#' + str(iterations), self.next_number(2))
+        self.emit("GOTO", head)
+
+    def generate(self):
+        # Zero both bytes of every counter and variable
+        for addr in COUNTERS + VARIABLES:
+            self.emit("COPY", "#0", '#' + str(addr))
+            self.emit("COPY", "#0", '#' + str(addr + 1))
+
+        kinds = list(self.weights.keys())
+        weights = list(self.weights.values())
+        while len(self.lines) < self.line_count - 1:
+            remaining = self.line_count - 1 - len(self.lines)
+            kind = self.rng.choices(kinds, weights)[0]
+
+            # Fall back to arithmetic once blocks no longer fit in the program, address space or screen
+            in_range = self.address < MAX_ADDRESS - 1000
+            if kind == "branch" and remaining >= 2 and in_range:
+                self.branch_block(remaining)
+            elif kind == "print" and in_range and self.text_location + 12 <= MAX_TEXT:
+                self.print_block()
+            elif kind == "loop" and remaining >= 5 and in_range:
+                self.loop_block(remaining)
+            else:
+                self.arith_block()
+
+        self.emit("DONE")
+
+        return self.lines
+
+
+'''
+    Reference model
+    Mirrors how the processor executes each FVCAL line, byte for byte
+'''
+
+
+def write_value(memory, addr, value):
+    # The bus writes integers in as few bytes as they fit in, and at least one
+    size = max(1, (value.bit_length() + 7) // 8)
+    memory[addr:addr + size] = value.to_bytes(size, "little")
+
+
+def read_value(memory, addr):
+    return int.from_bytes(memory[addr:addr + 2], "little")
+
+
+def signed(value):
+    return value - 0x10000 if value & 0x8000 else value
+
+
+def alu(op, a, b):
+    # 16-bit result of an arithmetic operator, and the flags it sets
+    overflow = False
+    if op == "ADD":
+        result = a + b
+        overflow = (a ^ result) & (b ^ result) & 0x8000
+    elif op == "MULT":
+        result = a * b
+        overflow = not -0x8000 <= signed(a) * signed(b) <= 0x7FFF
+    elif b == 0:
+        result = 0
+        overflow = True
+    else:
+        result = a % b if op == "MOD" else a // b
+
+    flags = 0b001 if result > 0xFFFF else 0
+    result &= 0xFFFF
+    if result == 0:
+        flags |= 0b010
+    if overflow:
+        flags |= 0b100
+
+    return result, flags
+
+
+def run_reference(lines):
+    memory = bytearray(0x10000)
+    index_of = {"'" + str(number): i for i, (number, op, params) in enumerate(lines)}
+
+    def value(param):
+        if param[0] == '#':
+            return int(param[1:])
+        return read_value(memory, int(param[1:]))
+
+    # PRINT locations are fixed when assembling
+    text_locations = []
+    text_location = 0
+    for number, op, params in lines:
+        text_locations.append(text_location)
+        if op == "PRINT":
+            text_location += len(params[0]) - 1 if params[0][0] == '\'' else 2
+
+    instructions = 0
+    flags = 0
+    i = 0
+    jumped = False
+    while True:
+        number, op, params = lines[i]
+        instructions += 1
+        i += 1
+        landed = jumped
+        jumped = False
+
+        if op == "DONE":
+            break
+
+        elif op == "COPY":
+            write_value(memory, int(params[1][1:]), value(params[0]))
+
+        # Arithmetic results are always written as two bytes
+        elif op in ("ADD", "MULT", "MOD", "DIV"):
+            result, flags = alu(op, value(params[0]), value(params[1]))
+            addr = int(params[2][1:])
+            memory[addr:addr + 2] = result.to_bytes(2, "little")
+
+        elif op == "GOTO":
+            i = index_of[params[0]]
+            jumped = True
+
+        elif op == "GTNUL":
+            if value(params[0]) == 0:
+                i = index_of[params[1]]
+                jumped = True
+
+        elif op == "GTFLG":
+            if flags & value(params[0]):
+                i = index_of[params[1]]
+                jumped = True
+
+        elif op == "GTEQL":
+            if value(params[0]) == value(params[1]):
+                i = index_of[params[2]]
+                jumped = True
+
+        elif op == "PRINT":
+            dest = TEXT_BASE + text_locations[i - 1]
+            if params[0][0] == '\'':
+                # A PRINT of a string also executes the jump over its data,
+                # unless it was jumped to, since line addresses point past the data
+                if not landed:
+                    instructions += 1
+                text = bytes(FVCTE_table[c] for c in params[0][1:])
+                memory[dest:dest + len(text)] = text
+
+            # CPYBLK copies both bytes of the variable, zeroes included
+            else:
+                addr = int(params[0][1:])
+                memory[dest:dest + 2] = memory[addr:addr + 2]
+
+    return {
+        "instructions": instructions,
+        "variables": {str(addr): read_value(memory, addr) for addr in VARIABLES},
+        "text": memory[TEXT_BASE:TEXT_BASE + text_location].hex()
+    }
+
+
+def generate(line_count, mix="mixed", seed=0):
+    # Returns the program source along with its expected results
+    generator = Generator(max(line_count, 2 * len(COUNTERS + VARIABLES) + 1), mix, seed)
+    lines = generator.generate()
+    source = '\n'.join(str(number) + ' ' + ' '.join([op] + params) for number, op, params in lines)
+
+    expected = run_reference(lines)
+    expected["lines"] = len(lines)
+    expected["mix"] = mix
+    expected["seed"] = seed
+    # Programs reaching into the data can still be assembled, but not run
+    expected["executable"] = generator.address <= COUNTER_BASE
+
+    return source, expected
+
+
+def get_input():
+    parser = argparse.ArgumentParser(description="FVCAL workload generator")
+    parser.add_argument("output", help="file to write the generated source to")
+    parser.add_argument("--lines", metavar="N", type=int, default=1000,
+                        help="number of lines to generate")
+    parser.add_argument("--mix", choices=list(mixes.keys()), default="mixed",
+                        help="instruction mix of the program")
+    parser.add_argument("--seed", metavar="N", type=int, default=0,
+                        help="seed for the random choices")
+    parser.add_argument("--expected", metavar="FILE",
+                        help="write the expected results as JSON to FILE")
+    args = parser.parse_args()
+
+    source, expected = generate(args.lines, args.mix, args.seed)
+
+    out_file = open(args.output, 'w')
+    out_file.write(source + '\n')
+    out_file.close()
+
+    if args.expected is not None:
+        out_file = open(args.expected, 'w')
+        json.dump(expected, out_file, indent=4, sort_keys=True)
+        out_file.write('\n')
+        out_file.close()
+
+
+if __name__ == '__main__':
+    get_input()
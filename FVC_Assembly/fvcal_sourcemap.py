@@ -0,0 +1,118 @@
+"""
+    Source maps for Fun Virtual Computer machine code
+    Written next to a binary by the assembler (-g), and read by profilers and tracers to turn
+    instruction pointer values back into FVCAL lines
+
+    Usage:
+        fvcal_sourcemap.py <map file> <address> [<address> ...]
+
+    File layout (little-endian):
+        Header  | magic 'FVCM', u16 version, u16 reserved, u32 range count, u32 name count
+        Ranges  | u32 start, u32 end (exclusive), u32 line number, u16 op name, u16 part name
+        Names   | u8 length, followed by the name in ASCII
+
+    Ranges are sorted by start address and never overlap, so any address is found with a binary search.
+    The op is the FVCAL operator of the line, and the part is the piece of its expansion the range
+    covers, such as the JMP, DATA and CPYBLK a PRINT expands to.
+"""
+
+from array import array
+from bisect import bisect_right
+from sys import argv
+import struct
+
+MAGIC = b"FVCM"
+VERSION = 1
+
+header_format = struct.Struct("<4sHHII")
+range_format = struct.Struct("<IIIHH")
+
+
+def write_source_map(path, ranges):
+    # ranges is a list of (start, end, line number, op, part) tuples, in address order
+    names = []
+    name_index = {}
+    for r in ranges:
+        for name in r[3:]:
+            if name not in name_index:
+                name_index[name] = len(names)
+                names.append(name)
+
+    data = bytearray(header_format.pack(MAGIC, VERSION, 0, len(ranges), len(names)))
+    for start, end, number, op, part in ranges:
+        data += range_format.pack(start, end, number, name_index[op], name_index[part])
+
+    for name in names:
+        encoded = name.encode("ASCII")
+        data.append(len(encoded))
+        data += encoded
+
+    out_file = open(path, 'wb')
+    out_file.write(data)
+    out_file.close()
+
+
+class SourceMap:
+    def __init__(self, path):
+        data = open(path, 'rb').read()
+        magic, version, reserved, range_count, name_count = header_format.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a version " + str(VERSION) + " FVC source map: " + path)
+
+        # Keep each field in its own array, so lookups never build tuples for ranges they skip
+        self.starts = array('I')
+        self.ends = array('I')
+        self.numbers = array('I')
+        self.ops = array('H')
+        self.parts = array('H')
+
+        ranges_end = header_format.size + range_count * range_format.size
+        for start, end, number, op, part in range_format.iter_unpack(data[header_format.size:ranges_end]):
+            self.starts.append(start)
+            self.ends.append(end)
+            self.numbers.append(number)
+            self.ops.append(op)
+            self.parts.append(part)
+
+        self.names = []
+        position = ranges_end
+        for i in range(name_count):
+            length = data[position]
+            self.names.append(data[position + 1:position + 1 + length].decode("ASCII"))
+            position += 1 + length
+
+    def find(self, address):
+        # Index of the range holding address, or -1
+        i = bisect_right(self.starts, address) - 1
+        if i >= 0 and address < self.ends[i]:
+            return i
+
+        return -1
+
+    def lookup(self, address):
+        # Returns (line number, op, part) for address, or None if no line was assembled there
+        i = self.find(address)
+        if i < 0:
+            return None
+
+        return self.numbers[i], self.names[self.ops[i]], self.names[self.parts[i]]
+
+    def line_counts(self, addresses):
+        # Number of sampled addresses falling on each line number
+        counts = {}
+        for address in addresses:
+            i = self.find(address)
+            if i >= 0:
+                number = self.numbers[i]
+                counts[number] = counts.get(number, 0) + 1
+
+        return counts
+
+
+if __name__ == '__main__':
+    if len(argv) < 3:
+        print("Usage:\n    fvcal_sourcemap.py <map file> <address> [<address> ...]")
+    else:
+        source_map = SourceMap(argv[1])
+        for a in argv[2:]:
+            print(a, source_map.lookup(int(a, 0)))
@@ -0,0 +1,289 @@
+"""
+    Benchmark suite for the Fun Virtual Computer
+    Times the bus, processor, display, boot and assembler hot paths headless
+
+    Usage:
+        run.py [--repeat <n>] [--filter <text>] [--output <file>] [--compare <file>]
+
+    Every benchmark is run several times and reported as median and percentile timings.
+    Results are saved as JSON so runs from different commits can be compared with --compare.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+from time import perf_counter
+
+benchmarks_path = os.path.dirname(os.path.abspath(__file__))
+root_path = os.path.dirname(benchmarks_path)
+sys.path.insert(0, root_path)
+sys.path.insert(0, os.path.join(root_path, "FVC_Assembly"))
+
+import computer_interface
+import fvcal_assembler
+import fvcal_generator
+from components import bus
+
+ram_bound = computer_interface.ram_bound
+
+
+'''
+    Helpers
+'''
+
+
+def assemble(source):
+    # Assemble FVCAL source in memory and return the program without its header
+    return fvcal_assembler.assemble(source)[0][4:]
+
+
+def loop_source(body, iterations):
+    # A counted loop around the given body lines
+    lines = ["0 COPY #0 #300"]
+    number = 10
+    for line in body:
+        lines.append(str(number) + " " + line)
+        number += 10
+
+    lines.append(str(number) + " ADD #1 $300 #300")
+    lines.append(str(number + 10) + " GTEQL $300 #" + str(iterations) + " '" + str(number + 30))
+    lines.append(str(number + 20) + " GOTO '10")
+    lines.append(str(number + 30) + " DONE")
+
+    return '\n'.join(lines)
+
+
+def countdown_source(body, iterations):
+    # The same loop counted down with a single GTDNZ
+    lines = ["0 COPY #" + str(iterations) + " #300"]
+    number = 10
+    for line in body:
+        lines.append(str(number) + " " + line)
+        number += 10
+
+    lines.append(str(number) + " GTDNZ #300 '10")
+    lines.append(str(number + 10) + " DONE")
+
+    return '\n'.join(lines)
+
+
+def percentile(samples, fraction):
+    # Nearest-rank percentile of sorted samples
+    index = min(len(samples) - 1, max(0, int(round(fraction * len(samples) + 0.5)) - 1))
+    return samples[index]
+
+
+'''
+    Benchmarks
+    Each benchmark sets up its state, and returns a function that runs one sample
+    along with the number of operations a sample performs and the unit they are counted in
+'''
+
+
+def bench_bus_write():
+    def sample():
+        for i in range(10000):
+            bus.io(1, 500, 0x1234)
+
+    return sample, 10000, "writes"
+
+
+def bench_bus_read():
+    def sample():
+        for i in range(10000):
+            bus.io(0, 500, 2)
+
+    return sample, 10000, "reads"
+
+
+def processor_bench(body, make_source=loop_source):
+    def setup():
+        program = assemble(make_source(body, 500))
+        counter = {"instructions": 0}
+
+        def sample():
+            # COPY writes the counter's start value as a single byte, and some bodies add to 302,
+            # so clear both words for every sample to run the same loop
+            bus.io(1, 300, bytes(4))
+            with contextlib.redirect_stdout(io.StringIO()):
+                counter["instructions"] = bus.processor.process_instructions(program)
+
+        # Count the instructions once, since the loop always runs the same path
+        sample()
+        return sample, counter["instructions"], "instructions"
+
+    return setup
+
+
+def screen_bench(mode, changed=True):
+    def setup():
+        bus.io(1, ram_bound + bus.vid.palette_bound, mode)
+
+        # Fill the screen with text, so text mode has glyphs to draw
+        text = bytes(0x10 + i % 0x3e for i in range(4000))
+        bus.io(1, ram_bound + bus.vid.colour_bound, text)
+        counter = {"frame": 0}
+
+        def sample():
+            # Unchanged text frames are not drawn again, so change a character unless timing that
+            if changed:
+                counter["frame"] += 1
+                bus.io(1, ram_bound + bus.vid.colour_bound, 0x10 + counter["frame"] % 0x3e)
+            bus.vid.refresh()
+
+        return sample, 1, "frames"
+
+    return setup
+
+
+def bench_dma_frame():
+    # A whole graphics frame copied into VRAM by the DMA controller
+    registers = bus.mapping["dma"][0]
+    bus.io(1, registers, (0).to_bytes(2, "little") + ram_bound.to_bytes(2, "little") +
+           bus.vid.colour_bound.to_bytes(2, "little"))
+
+    def sample():
+        bus.io(1, registers + 6, 1)
+
+    return sample, bus.vid.colour_bound, "bytes"
+
+
+def bench_blitter_fill():
+    # A full-screen rectangle filled by the blitter
+    registers = bus.mapping["blt"][0]
+    width, height = bus.vid.true_resolution
+    bus.io(1, registers + 1, bytes([5]))
+    bus.io(1, registers + 4, bytes(4) + width.to_bytes(2, "little") + height.to_bytes(2, "little"))
+
+    def sample():
+        bus.io(1, registers, 1)
+
+    return sample, width * height, "pixels"
+
+
+def bench_boot():
+    def sample():
+        bus.reset()
+        bus.vid.headless = True
+        with contextlib.redirect_stdout(io.StringIO()):
+            computer_interface.boot()
+
+    return sample, 1, "boots"
+
+
+def assembler_bench(line_count):
+    def setup():
+        source, expected = fvcal_generator.generate(line_count, "mixed", 0)
+
+        def sample():
+            assemble(source)
+
+        return sample, line_count, "lines"
+
+    return setup
+
+
+benchmarks = {
+    "bus.write": bench_bus_write,
+    "bus.read": bench_bus_read,
+    "cpu.add_loop": processor_bench(["ADD $300 #7 #302"]),
+    "cpu.mod_loop": processor_bench(["MOD $300 #7 #302"]),
+    "cpu.div_loop": processor_bench(["DIV $300 #7 #302"]),
+    "cpu.jmp_loop": processor_bench(["GOTO '20", "GOTO '30", "GOTO '40"]),
+    "cpu.djnz_loop": processor_bench(["ADD $302 #7 #302"], countdown_source),
+    "screen.graphics_refresh": screen_bench(0),
+    "screen.text_refresh": screen_bench(1),
+    "screen.text_unchanged": screen_bench(1, False),
+    "dma.frame_copy": bench_dma_frame,
+    "blitter.fill_screen": bench_blitter_fill,
+    "boot": bench_boot,
+    "assembler.1k_lines": assembler_bench(1000),
+    "assembler.20k_lines": assembler_bench(20000),
+    "assembler.100k_lines": assembler_bench(100000),
+}
+
+
+def run_benchmark(setup, repeat):
+    sample, operations, unit = setup()
+
+    timings = []
+    for i in range(repeat):
+        start_time = perf_counter()
+        sample()
+        timings.append(perf_counter() - start_time)
+
+    timings.sort()
+    median = percentile(timings, 0.5)
+
+    return {
+        "unit": unit,
+        "operations": operations,
+        "samples": repeat,
+        "min": timings[0],
+        "median": median,
+        "p90": percentile(timings, 0.9),
+        "p99": percentile(timings, 0.99),
+        "max": timings[-1],
+        "rate": operations / median if median > 0 else 0
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=root_path,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Fun Virtual Computer benchmarks")
+    parser.add_argument("--repeat", metavar="N", type=int, default=7,
+                        help="samples taken of each benchmark")
+    parser.add_argument("--filter", metavar="TEXT", default="",
+                        help="only run benchmarks whose name contains TEXT")
+    parser.add_argument("--output", metavar="FILE",
+                        help="save the results as JSON to FILE")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="an earlier results file to compare against")
+    args = parser.parse_args(args)
+
+    # Start from a booted, headless machine
+    bus.vid.headless = True
+    with contextlib.redirect_stdout(io.StringIO()):
+        computer_interface.boot()
+
+    results = {}
+    for name, setup in benchmarks.items():
+        if args.filter not in name:
+            continue
+
+        result = run_benchmark(setup, max(1, args.repeat))
+        results[name] = result
+        print("%-26s median %10.3f ms   p90 %10.3f ms   %14.1f %s/s" %
+              (name, result["median"] * 1000, result["p90"] * 1000, result["rate"], result["unit"]))
+
+    if args.compare is not None:
+        previous = json.load(open(args.compare, 'r'))["results"]
+        print("\nCompared to", args.compare)
+        for name, result in results.items():
+            if name in previous and previous[name]["median"] > 0:
+                print("%-26s %6.2fx" % (name, previous[name]["median"] / result["median"]))
+
+    if args.output is not None:
+        out_file = open(args.output, 'w')
+        json.dump({
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "results": results
+        }, out_file, indent=4, sort_keys=True)
+        out_file.write('\n')
+        out_file.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
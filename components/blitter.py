@@ -0,0 +1,146 @@
+from components import bus
+
+'''
+    Virtual blitter and sprite engine for FFVC
+    Draws rectangles into graphics VRAM without packing 3-bit pixels in guest code, and keeps
+    a table of sprites the display draws over the graphics at every refresh
+
+    Registers
+    --------------------------------------
+    Offset | Purpose
+    0      | command, writing it runs the command
+    1      | fill colour
+    2      | transparent colour, skipped by copies and sprites (8 or above skips nothing)
+    3      | unused
+    4..5   | x
+    6..7   | y
+    8..9   | width
+    10..11 | height
+    12..13 | source address
+    14..15 | unused
+    16..79 | 8 sprites of 8 bytes: x (2), y (2), image address (2), width (1), height (1)
+
+    Commands:
+        1: Fill, sets every pixel of the rectangle to the fill colour
+        2: Copy, copies an image to the rectangle
+
+    Images hold one byte per pixel, row by row, each byte a palette index from 0 to 7.
+    Rectangles and sprites are clipped to the screen. A sprite is hidden while its width or
+    height is 0, and moving it only takes a write to its position, since sprites never touch VRAM.
+'''
+COMMAND = 0
+COLOUR = 1
+TRANSPARENT = 2
+X = 4
+Y = 6
+WIDTH = 8
+HEIGHT = 10
+SOURCE = 12
+SPRITES = 16
+REGISTER_SIZE = 16
+
+SPRITE_COUNT = 8
+SPRITE_SIZE = 8
+
+COMMAND_FILL = 1
+COMMAND_COPY = 2
+
+# Bit offset of each of the 8 pixels in a packed group of 3 bytes
+PIXEL_SHIFTS = (21, 18, 15, 12, 9, 6, 3, 0)
+
+
+def unpack_pixels(data):
+    # Palette index of every pixel in packed graphics data
+    pixels = bytearray()
+    for i in range(0, len(data) - 2, 3):
+        group = (data[i] << 16) | (data[i + 1] << 8) | data[i + 2]
+        pixels += bytes((group >> shift) & 0b111 for shift in PIXEL_SHIFTS)
+
+    return pixels
+
+
+def pack_pixels(pixels):
+    # Packs palette indices back into 3 bytes for every 8 pixels
+    data = bytearray()
+    for i in range(0, len(pixels), 8):
+        group = 0
+        for p in pixels[i:i + 8]:
+            group = (group << 3) | (p & 0b111)
+        data += group.to_bytes(3, "big")
+
+    return data
+
+
+def word(registers, offset):
+    return int.from_bytes(registers[offset:offset + 2], "little")
+
+
+class Blitter:
+    def __init__(self, base, vram):
+        # Bus addresses of the registers and of graphics VRAM
+        self.base = base
+        self.vram = vram
+
+    def reset(self):
+        pass
+
+    def write(self, loc, data):
+        # Only a write reaching the command byte runs a command
+        if not loc <= COMMAND < loc + len(data):
+            return
+
+        # The bus stores data after this returns, so lay it over the registers already in memory
+        registers = bytearray(bus.io(2, self.base, REGISTER_SIZE))
+        registers[loc:loc + len(data)] = data[:REGISTER_SIZE - loc]
+
+        if registers[COMMAND] == COMMAND_FILL or registers[COMMAND] == COMMAND_COPY:
+            self.blit(registers)
+
+    def blit(self, registers):
+        width, height = bus.vid.true_resolution
+        row_size = width * 3 // 8
+
+        x = word(registers, X)
+        y = word(registers, Y)
+        rect_width = word(registers, WIDTH)
+        rect_height = word(registers, HEIGHT)
+        source = word(registers, SOURCE)
+        transparent = registers[TRANSPARENT]
+
+        # Clip the rectangle to the screen
+        left = min(x, width)
+        right = min(x + rect_width, width)
+        bottom = min(y + rect_height, height)
+        if left >= right:
+            return
+
+        # Only the rows the rectangle covers are unpacked and written back
+        for row_y in range(min(y, height), bottom):
+            address = self.vram + row_y * row_size
+            pixels = unpack_pixels(bus.io(2, address, row_size))
+
+            if registers[COMMAND] == COMMAND_FILL:
+                pixels[left:right] = bytes([registers[COLOUR] & 0b111]) * (right - left)
+
+            else:
+                image_row = bus.io(2, source + (row_y - y) * rect_width + left - x, right - left)
+                for i in range(len(image_row)):
+                    if image_row[i] != transparent:
+                        pixels[left + i] = image_row[i] & 0b111
+
+            bus.io(1, address, pack_pixels(pixels))
+
+    def sprites(self):
+        # (x, y, width, height, image) of every visible sprite, and the transparent colour
+        table = bus.io(2, self.base, SPRITES + SPRITE_COUNT * SPRITE_SIZE)
+        visible = []
+        for offset in range(SPRITES, len(table), SPRITE_SIZE):
+            sprite_width = table[offset + 6]
+            sprite_height = table[offset + 7]
+            if sprite_width == 0 or sprite_height == 0:
+                continue
+
+            image = bus.io(2, word(table, offset + 4), sprite_width * sprite_height)
+            visible.append((word(table, offset), word(table, offset + 2), sprite_width, sprite_height, image))
+
+        return visible, table[TRANSPARENT]
@@ -1,4 +1,4 @@
-from components import memory, display, processor
+from components import memory, display, processor, keyboard, dma, blitter, console
 from math import ceil
 
 # ALL RANGES ARE INCLUSIVE
@@ -6,21 +6,48 @@ mapping = {
     "ram": (0, 33009),
     "vram": (1000, 33009),
     "snd": (33010, 33143),
+    "kbd": (33144, 33177),
+    "dma": (33178, 33185),
+    "blt": (33186, 33265),
+    "con": (33266, 33272),
 }
 min_addr = 0
-max_addr = 33143
+max_addr = 33272
 
 ram_size = mapping["ram"][1] - mapping["ram"][0] + 1
 vram_size = mapping["vram"][1] - mapping["vram"][0] + 1
 snd_size = mapping["snd"][1] - mapping["snd"][0] + 1
+kbd_size = mapping["kbd"][1] - mapping["kbd"][0] + 1
+dma_size = mapping["dma"][1] - mapping["dma"][0] + 1
+blt_size = mapping["blt"][1] - mapping["blt"][0] + 1
+con_size = mapping["con"][1] - mapping["con"][0] + 1
 
-mem = memory.MemBlock(ram_size, True)
+# Device registers are backed by memory too, so programs can read them back
+# One spare byte past the last register keeps 16-bit reads of it in bounds
+mem_size = max_addr + 2
+
+mem = memory.MemBlock(mem_size, True)
 vid = display.Screen(320, 200, 320, 200)
 snd = None
+kbd = keyboard.Keyboard(mapping["kbd"][0])
+dmac = dma.Dma(mapping["dma"][0])
+blt = blitter.Blitter(mapping["blt"][0], mapping["vram"][0])
+con = console.Console(mapping["con"][0], mapping["vram"][0] + vid.colour_bound)
 
 reserved_bytes = memory.reserved_bytes
 
 
+def reset():
+    # Return memory and the display to their power-on state
+    global mem
+    mem = memory.MemBlock(mem_size, True)
+    vid.reset()
+    kbd.reset()
+    dmac.reset()
+    blt.reset()
+    con.reset()
+
+
 def bus_msg(status_code, *args):
     status_messages = [
         "Unknown signal",
@@ -38,13 +65,17 @@ def bus_msg(status_code, *args):
 
 def io(signal, location, size_or_val):
     # Make sure location exists in memory map
-    if location not in range(min_addr, max_addr):
+    if location not in range(min_addr, max_addr + 1):
         bus_msg(1, location)
         quit()
 
     mem_addrs = mapping["ram"]
     vid_addrs = mapping["vram"]
     snd_addrs = mapping["snd"]
+    kbd_addrs = mapping["kbd"]
+    dma_addrs = mapping["dma"]
+    blt_addrs = mapping["blt"]
+    con_addrs = mapping["con"]
 
     # Read signal
     if signal == 0:
@@ -70,6 +101,26 @@ def io(signal, location, size_or_val):
             write_device = snd
             offset = snd_addrs[0]
 
+        # Are we writing to the keyboard?
+        elif location in range(kbd_addrs[0], kbd_addrs[1] + 1):
+            write_device = kbd
+            offset = kbd_addrs[0]
+
+        # Are we writing to the DMA controller?
+        elif location in range(dma_addrs[0], dma_addrs[1] + 1):
+            write_device = dmac
+            offset = dma_addrs[0]
+
+        # Are we writing to the blitter?
+        elif location in range(blt_addrs[0], blt_addrs[1] + 1):
+            write_device = blt
+            offset = blt_addrs[0]
+
+        # Are we writing to the console?
+        elif location in range(con_addrs[0], con_addrs[1] + 1):
+            write_device = con
+            offset = con_addrs[0]
+
         else:
             bus_msg(2, location)
             quit()
@@ -90,3 +141,28 @@ def io(signal, location, size_or_val):
     else:
         bus_msg(0)
         quit()
+
+
+def copy(source, destination, size):
+    # Copies a block of memory with a single slice assignment
+    # The block is read before it is written, so overlapping blocks copy correctly
+    if size == 0:
+        return
+
+    if source + size - 1 > max_addr:
+        bus_msg(1, source + size - 1)
+        quit()
+
+    # Writing goes through io, so any device the block lands in sees it
+    io(1, destination, mem.read(source, size))
+
+
+def move(source, destination, size):
+    # Copies a block of memory, then clears whatever part of the source was not overwritten
+    copy(source, destination, size)
+
+    for start, end in ((source, min(source + size, destination)),
+                       (max(source, destination + size), source + size)):
+        if start < end:
+            io(1, start, bytes(end - start))
+
@@ -0,0 +1,143 @@
+from components import bus, display
+
+'''
+    Virtual console for FFVC
+    Prints characters written to its port at a hardware cursor, so programs can write text
+    without keeping track of where in text VRAM it goes
+
+    Registers
+    --------------------------------------
+    Offset | Purpose
+    0      | cursor column
+    1      | cursor row, on the screen
+    2..3   | insert offset, where in the text buffer the next character is stored
+    4      | port, writing a character here prints it
+    5..6   | string address, writing an address here prints the string stored there
+
+    Characters are stored in the text buffer one after another, in the order they are printed.
+    Newline (0x05) and home (0x0e) are stored too, and move the cursor to the start of the next
+    line and to the top left of the screen. Nulls are not printed.
+
+    Printing past the end of a line wraps to the next one, and moving the cursor below the
+    bottom of the screen scrolls the text up a line with the text scroll register. Once the
+    text buffer is full, the text still on the screen is moved to the start of the buffer.
+
+    Only the first byte of a write to the port is printed, so 16-bit values print their low byte.
+    A string is a length byte followed by that many characters, and only a write starting at the
+    string address prints one.
+'''
+COLUMN = 0
+ROW = 1
+OFFSET = 2
+PORT = 4
+STRING = 5
+
+TEXT_SIZE = 4000
+TEXT_SCROLL = display.TEXT_SCROLL
+MAX_SCROLL = 255
+
+
+def visible_start(text, scroll, columns):
+    # Offset of the first character laid out on the top line of the screen, as the display lays it out
+    line = 0
+    x = 0
+    for i in range(len(text)):
+        if line >= scroll:
+            return i
+
+        c = text[i]
+        if c == 0x00:
+            continue
+        elif c == 0x05:
+            line += 1
+            x = 0
+        elif c == 0x0e:
+            line = scroll
+            x = 0
+        else:
+            x += 1
+            if x >= columns:
+                line += 1
+                x = 0
+
+    return len(text)
+
+
+class Console:
+    def __init__(self, base, text):
+        # Bus addresses of the registers and of the text buffer
+        self.base = base
+        self.text = text
+
+    def reset(self):
+        pass
+
+    def write(self, loc, data):
+        # Only a write reaching the port prints anything
+        if loc <= PORT < loc + len(data):
+            self.put(data[PORT - loc])
+
+        # The address is taken from the write itself, since an address below 256 is a single byte
+        elif loc == STRING:
+            self.put_string(int.from_bytes(data[:2], "little"))
+
+    def put_string(self, address):
+        for c in bus.io(2, address + 1, bus.io(0, address, 1)):
+            self.put(c)
+
+    def put(self, c):
+        if c == 0x00:
+            return
+
+        width, height = bus.vid.true_resolution
+        columns = width // 8
+        rows = height // 8
+
+        registers = bus.io(2, self.base, PORT)
+        column = registers[COLUMN]
+        row = registers[ROW]
+        offset = int.from_bytes(registers[OFFSET:OFFSET + 2], "little")
+
+        if offset >= TEXT_SIZE:
+            offset, column, row = self.compact(offset, column, row, columns)
+
+        bus.io(1, self.text + offset, c)
+        offset += 1
+
+        # Move the cursor
+        if c == 0x05:
+            column = 0
+            row += 1
+        elif c == 0x0e:
+            column = 0
+            row = 0
+        else:
+            column += 1
+            if column >= columns:
+                column = 0
+                row += 1
+
+        # Scroll the text up once the cursor leaves the bottom of the screen
+        if row >= rows and bus.io(0, TEXT_SCROLL, 1) >= MAX_SCROLL:
+            offset, column, row = self.compact(offset, column, row, columns)
+        if row >= rows:
+            bus.io(1, TEXT_SCROLL, bus.io(0, TEXT_SCROLL, 1) + 1)
+            row = rows - 1
+
+        bus.io(1, self.base, bytes((column, row)) + offset.to_bytes(2, "little"))
+
+    def compact(self, offset, column, row, columns):
+        # Moves the text on the screen to the start of the buffer, and returns the new insert offset
+        # and cursor. Text scrolled off the screen is dropped, and if no room would be made, everything
+        # is dropped and the cursor goes back to the top left
+        text = bus.io(2, self.text, TEXT_SIZE)
+        start = visible_start(text[:offset], bus.io(0, TEXT_SCROLL, 1), columns)
+        if start == 0:
+            start = offset
+            column = 0
+            row = 0
+
+        bus.io(1, self.text, text[start:offset] + bytes(TEXT_SIZE - (offset - start)))
+        bus.io(1, TEXT_SCROLL, 0)
+
+        return offset - start, column, row
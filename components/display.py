@@ -13,25 +13,35 @@ VM Display Specifications:
 
         000 000 00
         R   G   B
-        
+
     Memory:
     0 to 23999:     colour
     24000 to 31999: text
     32000 to 32007: palette
     32008: text(0) or graphics(1) mode?
     32009: refresh byte
-    
+
+    Reserved byte 25 holds the text scroll, the number of lines of text scrolled off the top
+
 '''
 
 # This display draws with pygame for simplicity, any library could be used
 import pygame
 #pygame.init()
 
+import os
+import struct
+import zlib
+
+# Reserved RAM byte holding the number of text lines scrolled off the top of the screen
+TEXT_SCROLL = 25
+
 
 def display_msg(status_code, *args):
     status_messages = [
         "Negative write location",
-        "Unknown display mode"
+        "Unknown display mode",
+        "Unknown frame format"
     ]
     if status_code >= len(status_messages):
         msg = "Unknown status code"
@@ -41,12 +51,202 @@ def display_msg(status_code, *args):
     print("Display message:", msg, *args)
 
 
+'''
+    Decoding
+    Both the pygame window and the frame exporter render VRAM into a flat 24-bit RGB buffer
+    (3 bytes per pixel, row by row) using the functions below
+'''
+
+
+def colour_to_rgb(c):
+    # Convert a 3-3-2 palette byte into its modern 24-bit rgb equivalent
+    r = (c >> 5) * 32
+    g = ((c >> 2) & 0b111) * 32
+    b = (c & 0b11) * 64
+
+    return bytes((r, g, b))
+
+
+def render_graphics(graphics, palette):
+    colours = [colour_to_rgb(c) for c in palette]
+    rgb = bytearray()
+
+    # Every 3 bytes of graphics data hold exactly 8 pixels of 3 bits each
+    for i in range(0, len(graphics) - 2, 3):
+        group = (graphics[i] << 16) | (graphics[i + 1] << 8) | graphics[i + 2]
+        for shift in (21, 18, 15, 12, 9, 6, 3, 0):
+            rgb += colours[(group >> shift) & 0b111]
+
+    return rgb
+
+
+def render_sprites(rgb, sprites, transparent, palette, width, height):
+    # Draw sprites over rendered graphics, in table order, skipping their transparent pixels
+    colours = [colour_to_rgb(c) for c in palette]
+
+    for x, y, sprite_width, sprite_height, image in sprites:
+        # Sprites are clipped at the right and bottom of the screen
+        columns = min(sprite_width, width - x)
+        for row in range(min(sprite_height, height - y)):
+            position = ((y + row) * width + x) * 3
+            for c in image[row * sprite_width:row * sprite_width + columns]:
+                if c != transparent:
+                    rgb[position:position + 3] = colours[c & 0b111]
+                position += 3
+
+    return rgb
+
+
+def render_text(rgb, text_data, fontmap, palette, width, height, scroll=0):
+    # Text is drawn with palette colour 0 as the background and colour 1 as the foreground
+    # The first scroll lines of text are laid out, but not drawn
+    background = colour_to_rgb(palette[0])
+    foreground = colour_to_rgb(palette[1])
+
+    chars_per_line = width // 8
+    chars_per_column = height // 8
+    stride = width * 3
+    bottom = scroll + chars_per_column
+
+    # Each glyph is rendered into 8 rows of rgb data only once per frame
+    glyph_rows = {}
+
+    x = 0
+    line = 0
+    # Iterate over each character ID
+    for c in text_data:
+        # Catch control characters
+        # Null
+        if c == 0x00:
+            continue
+
+        # Newline
+        elif c == 0x05:
+            line += 1
+            x = 0
+            continue
+
+        # Home, the top left of the screen
+        elif c == 0x0e:
+            line = scroll
+            x = 0
+            continue
+
+        # Make sure the loaded font supports the current character
+        # Fall back to the 0x00 char if char is unsupported
+        if c not in fontmap:
+            c = 0x00
+
+        if c not in glyph_rows:
+            rows = []
+            for glyph_row in fontmap[c]:
+                rows.append(b''.join(foreground if glyph_row & (0x80 >> bit) else background
+                                     for bit in range(8)))
+            glyph_rows[c] = rows
+
+        # Copy the glyph's rows into the frame
+        # Glyphs scrolled above the screen, or pushed below it by newlines, are clipped
+        if scroll <= line < bottom:
+            position = 8 * (line - scroll) * stride + 8 * x * 3
+            for row in glyph_rows[c]:
+                rgb[position:position + 24] = row
+                position += stride
+
+        x += 1
+
+        # If we have reached the end of the line...
+        if x >= chars_per_line:
+            # Increment the line register and reset the x pos
+            line += 1
+            x = 0
+
+        # Wrap the line register to the top of the screen if we try to draw text beyond the bottom
+        if line >= bottom:
+            line = scroll
+
+    return rgb
+
+
+def read_font():
+    # Raw font data from memory, a 4 byte header followed by 9 bytes per glyph
+    font_location_offset = 500
+
+    font_header = bus.io(2, bus.reserved_bytes + font_location_offset, 4)
+    font_size = font_header[3]
+    return bus.io(2, bus.reserved_bytes + font_location_offset, 4 + 9 * font_size)
+
+
+def read_fontmap(font=None):
+    # Read the font from memory
+    if font is None:
+        font = read_font()
+
+    font_keys = [font[i + 4] for i in range(0, len(font) - 4, 9)]
+    font_glyphs = [font[i + 1: i + 9] for i in range(4, len(font) - 1, 9)]
+
+    # Assemble the key-glyph font mapping
+    fontmap = {}
+    for i in range(len(font_keys)):
+        k = font_keys[i]
+        fontmap[k] = font_glyphs[i]
+
+    # Ensure the fontmap always contains a null glyph for fallback
+    fontmap[0x00] = bytes(8)
+
+    return fontmap
+
+
+'''
+    Exporting
+    Frames are written either as PNG images or as raw rgb data with no header
+'''
+
+
+def encode_png(rgb, width, height):
+    # Every scanline is prefixed with filter type 0 (none)
+    stride = width * 3
+    scanlines = bytearray()
+    for y in range(height):
+        scanlines.append(0)
+        scanlines += rgb[y * stride:(y + 1) * stride]
+
+    def chunk(tag, data):
+        body = tag + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body) & 0xffffffff)
+
+    # 8 bits per channel, truecolour, no interlacing
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) +
+            chunk(b"IDAT", zlib.compress(bytes(scanlines))) + chunk(b"IEND", b""))
+
+
+def write_frame(path, rgb, width, height, frame_format=None):
+    # Infer the format from the file extension if none is given
+    if frame_format is None:
+        frame_format = "png" if path.lower().endswith(".png") else "raw"
+
+    if frame_format == "png":
+        data = encode_png(rgb, width, height)
+    elif frame_format == "raw":
+        data = bytes(rgb)
+    else:
+        display_msg(2, frame_format)
+        quit()
+
+    out_file = open(path, 'wb')
+    out_file.write(data)
+    out_file.close()
+
+
 class Screen:
-    def __init__(self, host_width, host_height, true_width, true_height):
+    def __init__(self, host_width, host_height, true_width, true_height, headless=False):
 
         # Simulated values
+        # The window is only opened on the first refresh, and never when running headless
         self.resolution_on_host = (host_width, host_height)
-        self.surface = pygame.display.set_mode(self.resolution_on_host)
+        self.surface = None
+        self.headless = headless
 
         # Internal registers
         self.true_resolution = (true_width, true_height)
@@ -55,6 +255,19 @@ class Screen:
         self.line = 0
         self.x = 0
 
+        # The last rendered frame, as rgb data
+        self.framebuffer = bytearray(true_width * true_height * 3)
+        self.refresh_count = 0
+
+        # Everything the last text frame was rendered from, so unchanged text is not drawn again
+        self.text_inputs = None
+        self.text_frame = None
+
+        # Frame recording
+        self.record_dir = None
+        self.record_every = 1
+        self.record_format = "png"
+
         # Useful magic numbers
         self.colour_bound = 24000
         self.text_bound = 32000
@@ -62,6 +275,13 @@ class Screen:
         self.mode_bound = 32009
         self.refresh_bound = 32010
 
+    def reset(self):
+        self.palette[:] = bytes(len(self.palette))
+        self.mode[:] = bytes(len(self.mode))
+        self.framebuffer = bytearray(len(self.framebuffer))
+        self.refresh_count = 0
+        self.text_inputs = None
+
     def read(self, loc, size):
         return bus.io(2, loc, size)
 
@@ -108,78 +328,48 @@ class Screen:
         if len(mode) > 0:
             self.mode[:len(mode)] = mode
 
-    def refresh(self):
+    def render(self):
+        # Render the current VRAM into a new rgb buffer without touching the window
         # Graphics mode
         if self.mode[0] == 0:
-            # Load graphics data
+            # Load graphics data, and draw the sprites over it
             graphics = bus.io(2, 1000, self.colour_bound)
-            #text_data = bus.io(2, 1000 + self.colour_bound, 4000)
-
-            # Set up a bitstring for the graphics data
-            bit_graphics = ""
-            # Reformat the graphics data into bits
-            for g in graphics:
-                bitstring = format(g, 'b')
-                prefix = '0' * (8 - len(bitstring))
-                bitstring = prefix + bitstring
-                bit_graphics += bitstring
-
-            # Convert 3-bit strings into useable ints
-            bit_graphics = [bit_graphics[i:i + 3] for i in range(0, len(bit_graphics), 3)]
-            bit_graphics = [int(v, 2) for v in bit_graphics]
-
-            pixel_width = self.resolution_on_host[0] / self.true_resolution[0]
-            pixel_height = self.resolution_on_host[1] / self.true_resolution[1]
-
-            # Iterate over the graphics data and draw every pixel...
-            x_draw = 0
-            y_draw = 0
-
-            for g in bit_graphics:
-                c = self.palette[g]
-                c_bits = format(c, 'b')
-                prefix = '0' * (8 - len(c_bits))
-                c_bits = prefix + c_bits
-
-                r = int(c_bits[:3], 2)
-                g = int(c_bits[3:6], 2)
-                b = int(c_bits[6:8], 2)
-
-                # Convert r, g, and b into modern 24-bit rgb equivalents
-                r *= 32
-                g *= 32
-                b *= 64
-
-                pygame.draw.rect(self.surface, (r, g, b),
-                                 (x_draw * pixel_width, y_draw * pixel_height, pixel_width, pixel_height))
-
-                if x_draw >= self.true_resolution[0] - 1:
-                    x_draw = 0
-                    y_draw += 1
-                else:
-                    x_draw += 1
+            rgb = render_graphics(graphics, self.palette)
+            sprites, transparent = bus.blt.sprites()
+            return render_sprites(rgb, sprites, transparent, self.palette, *self.true_resolution)
 
         # Text mode
+        # Text is drawn over whatever was last displayed
         elif self.mode[0] == 1:
-            #y = bus.io(0, 22, 1)
-            font_location_offset = 500
-
-            # Read the font from memory
-            font_header = bus.io(2, bus.reserved_bytes + font_location_offset, 4)
-            font_size = font_header[3]
-            font = bus.io(2, bus.reserved_bytes + font_location_offset, 4 + 9 * font_size)
-            font_keys = [font[i + 4] for i in range(0, len(font) - 4, 9)]
-            font_glyphs = [font[i + 1: i + 9] for i in range(4, len(font) - 1, 9)]
-
-            # Assemble the key-glyph font mapping
-            fontmap = {}
-            for i in range(len(font_keys)):
-                k = font_keys[i]
-                fontmap[k] = font_glyphs[i]
+            # Get text, scroll and font from memory
+            text_data = bus.io(2, 1000 + self.colour_bound, 4000)
+            scroll = bus.io(0, TEXT_SCROLL, 1)
+            font = read_font()
+
+            # Drawing the same text over the frame it was drawn on changes nothing,
+            # so the frame is only rendered again if something it depends on was written since
+            inputs = (text_data, scroll, font, bytes(self.palette))
+            if inputs == self.text_inputs and self.framebuffer is self.text_frame:
+                return self.framebuffer
+
+            # Scrolling moves every line, so the text is drawn over the background instead
+            if self.text_inputs is not None and scroll != self.text_inputs[1]:
+                frame = bytearray(colour_to_rgb(self.palette[0]) * (len(self.framebuffer) // 3))
+            else:
+                frame = bytearray(self.framebuffer)
+
+            self.text_inputs = inputs
+            self.text_frame = render_text(frame, text_data, read_fontmap(font), self.palette,
+                                          *self.true_resolution, scroll)
+            return self.text_frame
 
-            # Ensure the fontmap always contains a null glyph for fallback
-            fontmap[0x00] = bytes(8)
+        else:
+            display_msg(1, self.mode)
+            quit()
 
+    def refresh(self):
+        # Text mode
+        if self.mode[0] == 1:
             # If the delta is set, copy keyboard input to vram at the insert pointer
             delta_set = bus.io(0, 24, 1)
 
@@ -192,97 +382,38 @@ class Screen:
                 # Reset the delta
                 bus.io(1, 24, 0)
 
-            # Get text from VRAM
-            text_data = bus.io(2, 1000 + self.colour_bound, 4000)
+        self.framebuffer = self.render()
 
-            glyph_surface = pygame.Surface((8, 8))
-            chars_per_line = self.true_resolution[0] // 8
-            chars_per_column = self.true_resolution[1] // 8
-
-            self.x = 0
-            self.line = 0
-            # Iterate over each character ID
-            for c in text_data:
-                # Catch control characters
-                # Null
-                if c == 0x00:
-                    continue
-
-                # Newline
-                elif c == 0x05:
-                    #bus.io(1, 22, y + 1)
-                    self.line += 1
-                    self.x = 0
-                    continue
-
-                # Home
-                elif c == 0x0e:
-                    #bus.io(1, 22, 0)
-                    self.line = 0
-                    self.x = 0
-                    continue
-
-                gx = 0
-                gy = 0
-                #y = bus.io(0, 22, 1)
-
-                # Make sure the loaded font supports the current character
-                try:
-                    glyph = fontmap[c]
-
-                # Fall back to the 0x00 char if char is unsupported
-                except KeyError:
-                    glyph = fontmap[0x00]
-
-                # Convert glyph data into an array of bits
-                glyph_bitstring_rows = []
-                for glyph_row in glyph:
-                    row_bitstring = format(glyph_row, 'b')
-                    prefix = '0' * (8 - len(row_bitstring))
-                    row_bitstring = prefix + row_bitstring
-                    glyph_bitstring_rows.append(row_bitstring)
-
-                # Render each array of bits onto a pygame surface
-                for glyph_bs_row in glyph_bitstring_rows:
-                    for bit in glyph_bs_row:
-                        c = self.palette[int(bit)]
-                        c_bits = format(c, 'b')
-                        prefix = '0' * (8 - len(c_bits))
-                        c_bits = prefix + c_bits
-
-                        r = int(c_bits[:3], 2)
-                        g = int(c_bits[3:6], 2)
-                        b = int(c_bits[6:8], 2)
-
-                        # Convert r, g, and b into modern 24-bit rgb equivalents
-                        r *= 32
-                        g *= 32
-                        b *= 64
-
-                        # Render a single pixel by drawing a line from one point to the same point
-                        pygame.draw.line(glyph_surface, (r, g, b), (gx, gy), (gx, gy))
-                        gx += 1
-
-                    gy += 1
-                    gx = 0
-
-                self.surface.blit(glyph_surface, (8 * self.x, 8 * self.line))
-                self.x += 1
-
-                # If we have reached the end of the line...
-                if self.x >= chars_per_line:
-                    # Increment the line register and reset the x pos
-                    #bus.io(1, 22, y + 1)
-                    self.line += 1
-                    self.x = 0
-
-                # Wrap the line register if we try to draw text beyond the bottom of the screen
-                if self.line >= chars_per_column:
-                    #bus.io(1, 22, 0)
-                    self.line = 0
+        # Save every Nth refresh when recording
+        if self.record_dir is not None and self.refresh_count % self.record_every == 0:
+            frame_name = "frame_%05d.%s" % (self.refresh_count // self.record_every, self.record_format)
+            write_frame(os.path.join(self.record_dir, frame_name), self.framebuffer,
+                        *self.true_resolution, self.record_format)
+        self.refresh_count += 1
 
-        else:
-            display_msg(1, self.mode)
-            quit()
+        if self.headless:
+            return
+
+        if self.surface is None:
+            self.surface = pygame.display.set_mode(self.resolution_on_host)
+
+        frame = pygame.image.frombuffer(bytes(self.framebuffer), self.true_resolution, "RGB")
+        if self.resolution_on_host != self.true_resolution:
+            frame = pygame.transform.scale(frame, self.resolution_on_host)
+
+        self.surface.blit(frame, (0, 0))
+        pygame.display.flip()
+
+    def screenshot(self, path, frame_format=None):
+        # Save the current VRAM as a single frame
+        write_frame(path, self.render(), *self.true_resolution, frame_format)
+
+    def record(self, directory, every=1, frame_format="png"):
+        # Save every Nth refresh into directory as a numbered frame sequence
+        # Passing None as the directory stops recording
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
 
-        pygame.display.flip()
\ No newline at end of file
+        self.record_dir = directory
+        self.record_every = max(1, every)
+        self.record_format = frame_format
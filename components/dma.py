@@ -0,0 +1,106 @@
+from components import bus
+
+'''
+    Virtual DMA controller for FFVC
+    Copies blocks of memory in bulk, so programs can fill VRAM or move the font without an
+    instruction per byte
+
+    Registers
+    --------------------------------------
+    Offset | Purpose
+    0..1   | source address
+    2..3   | destination address
+    4..5   | length in bytes
+    6      | control
+    7      | status
+
+    Control:
+        0: Start, writing the control byte with this bit set starts a transfer
+        1: Background, copy a chunk every device poll instead of all at once
+        2: Interrupt, raise interrupt 2 when the transfer is done
+
+    Status:
+        0: Busy, a background transfer is running
+        1: Done, the last transfer finished (cleared when the next one starts)
+
+    The registers are read when the transfer starts, so they can be set up for the next
+    transfer while a background one is running. Starting a transfer while busy cancels
+    the running one. A write reaching the status byte stores it over the status of the
+    transfer it started, so registers are best written up to the control byte.
+'''
+SOURCE = 0
+DESTINATION = 2
+LENGTH = 4
+CONTROL = 6
+STATUS = 7
+
+CONTROL_START = 0b001
+CONTROL_BACKGROUND = 0b010
+CONTROL_INTERRUPT = 0b100
+
+STATUS_BUSY = 0b01
+STATUS_DONE = 0b10
+
+# Bytes a background transfer copies every device poll
+CHUNK_SIZE = 1024
+
+
+class Dma:
+    def __init__(self, base):
+        # Bus address of the registers
+        self.base = base
+
+        # The running transfer, or a remaining length of 0
+        self.source = 0
+        self.destination = 0
+        self.remaining = 0
+        self.interrupt = False
+
+    def reset(self):
+        self.remaining = 0
+        self.interrupt = False
+
+    def write(self, loc, data):
+        # Only a write reaching the control byte can start a transfer
+        if not loc <= CONTROL < loc + len(data):
+            return
+
+        # The bus stores data after this returns, so lay it over the registers already in memory
+        registers = bytearray(bus.io(2, self.base, STATUS + 1))
+        registers[loc:loc + len(data)] = data[:STATUS + 1 - loc]
+
+        if registers[CONTROL] & CONTROL_START:
+            self.start(registers)
+
+    def start(self, registers):
+        control = registers[CONTROL]
+        self.source = int.from_bytes(registers[SOURCE:SOURCE + 2], "little")
+        self.destination = int.from_bytes(registers[DESTINATION:DESTINATION + 2], "little")
+        self.remaining = int.from_bytes(registers[LENGTH:LENGTH + 2], "little")
+        self.interrupt = bool(control & CONTROL_INTERRUPT)
+
+        if control & CONTROL_BACKGROUND:
+            bus.io(1, self.base + STATUS, STATUS_BUSY)
+        else:
+            self.transfer(self.remaining)
+
+    def transfer(self, size):
+        # Copies the next size bytes of the running transfer
+        size = min(size, self.remaining)
+        bus.copy(self.source, self.destination, size)
+        self.source += size
+        self.destination += size
+        self.remaining -= size
+
+        if self.remaining == 0:
+            bus.io(1, self.base + STATUS, STATUS_DONE)
+            if self.interrupt:
+                bus.processor.raise_interrupt(bus.processor.IRQ_DMA)
+
+    def busy(self):
+        return self.remaining > 0
+
+    def tick(self):
+        # Advances a background transfer by one chunk
+        if self.remaining > 0:
+            self.transfer(CHUNK_SIZE)
@@ -1,8 +1,10 @@
 from components import bus
+import pygame
 
 '''
     Virtual keyboard driver for FFVC
-    Keyboard writes a byte to reserved mem addrs 23 and 24
+    Keyboard writes a byte to reserved mem addrs 23 and 24, and queues every key press
+    in its memory-mapped event queue
 
     Byte format:
     --------------------------------------
@@ -20,7 +22,31 @@ from components import bus
         6:
         7: Backspace (takes priority)
 
+    Event queue
+    --------------------------------------
+    A ring buffer at the start of the keyboard's bus mapping, so no key press is lost
+    when several arrive before a program reads them
+
+    Offset | Purpose
+    0      | head: slot of the oldest unread event, advanced by programs after reading it
+    1      | tail: slot the next event is written to, advanced by the keyboard
+    2..33  | 16 slots of 2 bytes: FFVCTE key code, modifiers
+
+    Modifiers:
+        0: Shift key
+        1: Caps lock
+        2: Ctrl
+        3: Alt
+        4: Meta
+
+    The queue is empty when head equals tail, and holds at most 15 events.
+    Events arriving while it is full are dropped and counted.
 '''
+QUEUE_LENGTH = 16
+EVENT_SIZE = 2
+
+# pygame modifier flags for each modifier bit
+modifier_flags = [pygame.KMOD_SHIFT, pygame.KMOD_CAPS, pygame.KMOD_CTRL, pygame.KMOD_ALT, pygame.KMOD_META]
 
 # Maps ASCII to the arbitrary encoding I use for FFVC
 ascii_to_ffvcte = {
@@ -159,3 +185,54 @@ def parse_keys(x):
     last_input = bus.io(0, 23, 1)
     bus.io(1, 23, keycode)  # Addr 23 is the first input byte
     bus.io(1, 24, bitfield_delta)
+
+    modifiers = 0
+    for bit in range(len(modifier_flags)):
+        if shift & modifier_flags[bit]:
+            modifiers |= 1 << bit
+    bus.kbd.push_key(keycode, modifiers)
+
+
+class Keyboard:
+    def __init__(self, base):
+        # Bus address of the event queue
+        self.base = base
+
+        # Events lost to a full queue
+        self.dropped = 0
+
+    def reset(self):
+        self.dropped = 0
+
+    def write(self, loc, data):
+        # The queue lives in memory, so programs advancing the head need no handling here
+        pass
+
+    def push_key(self, keycode, modifiers=0):
+        # Adds an event at the tail of the queue, returning False if it was full
+        head = bus.io(0, self.base, 1)
+        tail = bus.io(0, self.base + 1, 1)
+        next_tail = (tail + 1) % QUEUE_LENGTH
+
+        if next_tail == head:
+            self.dropped += 1
+            return False
+
+        bus.io(1, self.base + 2 + tail * EVENT_SIZE, bytes((keycode, modifiers)))
+        bus.io(1, self.base + 1, next_tail)
+        bus.processor.raise_interrupt(bus.processor.IRQ_KEYBOARD)
+        return True
+
+    def pending(self):
+        # Number of events waiting to be read
+        return (bus.io(0, self.base + 1, 1) - bus.io(0, self.base, 1)) % QUEUE_LENGTH
+
+    def pump(self):
+        # Queue the key presses waiting in the window's event queue
+        # There is no window before the first refresh, or when running headless
+        if bus.vid.surface is None:
+            return
+
+        for e in pygame.event.get():
+            if e.type == pygame.KEYDOWN:
+                parse_keys(e)
@@ -9,9 +9,19 @@ from math import ceil
     0 to 3     | 0:4    | block size
     4 to 8     | 4:9    | earliest writeable address
     9 to 11    | 9:12   | Relative VRAM insert pointer
-    12 to 21   | 12:22  | free
+    12 to 19   | 12:20  | interrupt vectors
+    20         | 20:21  | interrupt mask
+    21         | 21:22  | pending interrupts
+    22         | 22:23  | flags
     23 to 24   | 23:25  | input
-    26 to 31   | 26:32  | free
+    25         | 25:26  | text scroll
+    26 to 27   | 26:28  | interrupt return address
+    28 to 29   | 28:30  | timer period
+    30 to 31   | 30:32  | stack pointer
+
+    The PAL and MOD assembler keywords used to name bytes 12 and 21. Those bytes now hold the
+    interrupt vectors and pending interrupts, so the keywords name the display's palette and
+    mode registers instead.
 '''
 
 reserved_bytes = 32
@@ -115,4 +125,4 @@ class MemBlock:
         return int.from_bytes(self.data[4:9], "little")
 
     def set_write_bound(self, loc):
-        self.data[4:9] = loc.to_bytes(4, "little")
+        self.data[4:9] = loc.to_bytes(5, "little")
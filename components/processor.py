@@ -1,19 +1,19 @@
 # Virtual machine for fun
 # Bert Myroon
 # 21 Oct., 2020
-from components import bus
-from math import ceil
+from components import bus, memory
+from time import monotonic, sleep
 
 
 def processor_msg(status_code, *args):
     status_messages = [
         "Terminated successfully",
-        "reserved 1",
-        "reserved 2",
+        "Bad program header",
+        "Unknown register",
         "Unknown opcode",
         "Status:",
-        "reserved 5",
-        "reserved 6",
+        "Stack overflow",
+        "Stack underflow",
         "reserved 7",
         "reserved 8",
         "Unknown parameter mode",
@@ -50,6 +50,18 @@ def processor_msg(status_code, *args):
     12: MOVBLK {i_mode, o_mode, size, p1, a_out}
     13: MOD {p1_mode, p2_mode, o_mode, p1, p2, a_out}
     14: DIV {p1_mode, p2_mode, o_mode, p1, p2, a_out},
+    15: RETURN FROM INTERRUPT {}
+    16: WAIT FOR INTERRUPT {}
+    17: JMP if flags {a_dest_mode, p1_mode, a_dest, p1}, jumps if any flag in the mask p1 is set
+    18: INC {o_mode, a_out}
+    19: DEC {o_mode, a_out}
+    20: JMP if less {a_dest_mode, p1_mode, p2_mode, a_dest, p1, p2}, jumps if p1 < p2 (unsigned)
+    21: JMP if greater {a_dest_mode, p1_mode, p2_mode, a_dest, p1, p2}, jumps if p1 > p2 (unsigned)
+    22: DEC and JMP if not zero {a_dest_mode, o_mode, a_dest, a_out}
+    23: PUSH {i_mode, p1}
+    24: POP {o_mode, a_out}
+    25: CALL {a_dest_mode, a_dest}, pushes the address of the next instruction, then jumps
+    26: RET {}, pops an address and jumps to it
     
     PARAMETER MODES
     -----------------------------------------------------------------
@@ -57,6 +69,8 @@ def processor_msg(status_code, *args):
     1 - pointer, treat parameter as pointer to literal (ptr to num, or ptr to ptr)
     2(jmp) - direct, relative
     3(jmp) - pointer, relative
+    4 - register, treat parameter as the number of a register (r0 to r7), holding a num or ptr
+    16 to 23 - indexed, treat parameter plus register 0 to 7 as pointer to literal (ptr to num, or ptr to ptr)
     
     ******************************************************************
     A mode 0 input is a literal, and a mode 0 output is a pointer to an address.
@@ -77,10 +91,313 @@ def processor_msg(status_code, *args):
     -------------------------------------------------------------------
     OPC register: opcode
     IPT register: instruction pointer
+    r0 to r7: 16-bit registers, only reachable through register mode
+    
+    STACK
+    -------------------------------------------------------------------
+    Address 30 - 31 holds the stack pointer, the address of the last word pushed.
+    The stack grows down from 33000, through the part of text VRAM that is never displayed,
+    and the pointer is reset to 33000 whenever a program is run. Pushing below 29000 is a stack
+    overflow, and popping from an empty stack is a stack underflow, both stop the program.
+    
+    FLAGS
+    -------------------------------------------------------------------
+    Address 22 holds the flags set by ADD, MULT, MOD, DIV, INC, DEC and DJNZ
+    bit 0: carry, the result did not fit in 16 bits, or a DEC borrowed
+    bit 1: zero, the result is zero
+    bit 2: overflow, the signed result did not fit in 16 bits, or a division by zero
+    
+    INTERRUPTS
+    -------------------------------------------------------------------
+    Address | Purpose
+    12 - 19 | vector table, the handler address of each interrupt (2 bytes each)
+    20      | mask, bit n enables interrupt n
+    21      | pending, bit n is set while interrupt n waits to be handled
+    26 - 27 | return address, saved when a handler is entered
+    28 - 29 | timer period in milliseconds, 0 stops the timer
+    
+    Interrupts are taken between instructions, lowest number first. Handlers can not be
+    interrupted, and end with RETI, which returns to the saved address. WAIT sleeps until an
+    enabled interrupt is pending, and does nothing if every interrupt is masked.
+    
+    0: keyboard, raised for every queued key press
+    1: timer, raised every period
+    2: DMA, raised when a transfer asking for an interrupt is done
+'''
+
+INT_VECTORS = 12
+INT_MASK = 20
+INT_PENDING = 21
+INT_RETURN = 26
+TIMER_PERIOD = 28
+
+IRQ_KEYBOARD = 0
+IRQ_TIMER = 1
+IRQ_DMA = 2
+
+# Set when an interrupt may be pending, so the memory-mapped registers are not read after every instruction
+interrupt_requested = False
+
+# Seconds WAIT sleeps between checks for a pending interrupt
+WAIT_SLEEP = 0.001
+
+
+def raise_interrupt(irq):
+    # Marks an interrupt as pending, it is taken after the current instruction if it is enabled
+    global interrupt_requested
+    bus.io(1, INT_PENDING, bus.io(0, INT_PENDING, 1) | (1 << irq))
+    interrupt_requested = True
+
+
+def next_interrupt():
+    # Lowest enabled pending interrupt, or -1 if there is none
+    enabled = bus.io(0, INT_PENDING, 1) & bus.io(0, INT_MASK, 1)
+    if enabled == 0:
+        return -1
+
+    return (enabled & -enabled).bit_length() - 1
+
+
+def tick_timer(deadline):
+    # Raises the timer interrupt once the deadline has passed, and returns the next deadline
+    period = bus.io(0, TIMER_PERIOD, 2)
+    if period == 0:
+        return None
+
+    now = monotonic()
+    if deadline is None:
+        return now + period / 1000
+
+    if now >= deadline:
+        raise_interrupt(IRQ_TIMER)
+        return now + period / 1000
+
+    return deadline
+
+
+'''
+    Operand decoding
+    Every instruction reads its parameters through these, so each mode is handled in one place
+'''
+MODE_DIRECT = 0
+MODE_POINTER = 1
+MODE_REGISTER = 4
+MODE_INDEXED = 0x10
+
+# The register file, visible to programs through register mode
+REGISTER_COUNT = 8
+registers = [0] * REGISTER_COUNT
+
+
+def register_number(location):
+    # Register named by the parameter at location
+    number = bus.io(0, location, 2)
+    if number >= REGISTER_COUNT:
+        processor_msg(2, number, "at", location)
+        quit()
+
+    return number
+
+
+def index_register(mode):
+    # Register added to the base address of an indexed mode
+    if mode - MODE_INDEXED >= REGISTER_COUNT:
+        processor_msg(9, mode)
+        quit()
+
+    return registers[mode - MODE_INDEXED]
+
+
+def read_operand(mode, location):
+    # Value of the input parameter at location
+    # Direct mode is the parameter itself
+    if mode == MODE_DIRECT:
+        return bus.io(0, location, 2)
+
+    # Pointer mode is the value at the address in the parameter
+    elif mode == MODE_POINTER:
+        return bus.io(0, bus.io(0, location, 2), 2)
+
+    # Register mode is the value in the register named by the parameter
+    elif mode == MODE_REGISTER:
+        return registers[register_number(location)]
+
+    # Indexed modes are the value at the address in the parameter, plus the index register
+    elif mode >= MODE_INDEXED:
+        return bus.io(0, bus.io(0, location, 2) + index_register(mode), 2)
+
+    processor_msg(9, mode)
+    quit()
+
+
+def operand_address(mode, location):
+    # Address the output or block parameter at location refers to
+    # Direct mode is the address in the parameter
+    if mode == MODE_DIRECT:
+        return bus.io(0, location, 2)
+
+    # Pointer mode is the address stored at the address in the parameter
+    elif mode == MODE_POINTER:
+        return bus.io(0, bus.io(0, location, 2), 2)
+
+    # Register mode is the address held in the register
+    elif mode == MODE_REGISTER:
+        return registers[register_number(location)]
+
+    # Indexed modes are the address in the parameter, plus the index register
+    elif mode >= MODE_INDEXED:
+        return bus.io(0, location, 2) + index_register(mode)
+
+    processor_msg(10, mode)
+    quit()
+
+
+def write_operand(mode, location, value):
+    # Writes value to the output parameter at location
+    # Registers are as wide as the parameters they are read in place of
+    if mode == MODE_REGISTER:
+        registers[register_number(location)] = value & 0xFFFF
+
+    else:
+        bus.io(1, operand_address(mode, location), value)
+
+
+def read_output(mode, location):
+    # Current value of the output parameter at location, the word write_word would replace
+    if mode == MODE_REGISTER:
+        return registers[register_number(location)]
+
+    return bus.io(0, operand_address(mode, location), 2)
+
+
+def write_word(mode, location, value):
+    # Writes a 16-bit value to the output parameter at location, always as two bytes
+    if mode == MODE_REGISTER:
+        registers[register_number(location)] = value
+
+    else:
+        bus.io(1, operand_address(mode, location), value.to_bytes(2, "little"))
+
+
 '''
+    Arithmetic
+    ADD, MULT, MOD, DIV, INC and DEC work on 16-bit values, and their results wrap to 16 bits
+'''
+FLAGS = 22
+FLAG_CARRY = 0b001
+FLAG_ZERO = 0b010
+FLAG_OVERFLOW = 0b100
+
+
+def to_signed(value):
+    # Two's complement value of a 16-bit word
+    return value - 0x10000 if value & 0x8000 else value
+
+
+def set_flags(result, overflow):
+    # Sets the flags register from an arithmetic result, and returns the result wrapped to 16 bits
+    # Carry: the result did not fit in 16 bits, or went below zero
+    # Zero: the wrapped result is zero
+    # Overflow: the signed result did not fit in 16 bits, or a division by zero
+    flags = 0
+    if result > 0xFFFF or result < 0:
+        flags |= FLAG_CARRY
+    result &= 0xFFFF
+    if result == 0:
+        flags |= FLAG_ZERO
+    if overflow:
+        flags |= FLAG_OVERFLOW
+
+    bus.io(1, FLAGS, flags)
+    return result
+
+
+'''
+    Stack
+    PUSH, POP, CALL and RET move 16-bit words through the stack at the stack pointer
+'''
+STACK_POINTER = 30
+STACK_TOP = 33000
+STACK_LIMIT = 29000
+
+
+def push(value):
+    # Pushes a 16-bit word, growing the stack down
+    # Pushing past the limit would overwrite the displayed text
+    sp = bus.io(0, STACK_POINTER, 2) - 2
+    if sp < STACK_LIMIT:
+        processor_msg(5, "at", sp)
+        quit()
+
+    bus.io(1, sp, value.to_bytes(2, "little"))
+    bus.io(1, STACK_POINTER, sp.to_bytes(2, "little"))
+
+
+def pop():
+    # Pops the last pushed 16-bit word
+    # Popping an empty stack would read the palette and mode registers
+    sp = bus.io(0, STACK_POINTER, 2)
+    if sp + 2 > STACK_TOP:
+        processor_msg(6, "at", sp)
+        quit()
+
+    bus.io(1, STACK_POINTER, (sp + 2).to_bytes(2, "little"))
+
+    return bus.io(0, sp, 2)
+
+
+def read_target(mode, location):
+    # Jump address (or relative offset) of the jump parameter at location
+    # Modes 2 and 3 are the relative versions of modes 0 and 1
+    if mode == 2 or mode == 3:
+        mode -= 2
+
+    return read_operand(mode, location)
+
+
+# Key presses are queued, the timer is checked and background DMA advances every this many instructions
+DEVICE_POLL_INTERVAL = 256
+
+# Assembled binaries start with the magic bytes 9I6, followed by the assembler version
+# Binaries from other versions encode instructions differently, so they are not loaded
+PROGRAM_MAGIC = b"9I6"
+PROGRAM_VERSION = 5
+PROGRAM_HEADER_SIZE = 4
+
+
+def load(program, address=memory.reserved_bytes):
+    # Copies a program into RAM in a single bus write, and returns its size
+    # The first 32 bytes are reserved and should not be touched
+    bus.io(1, address, bytes(program))
+
+    return len(program)
+
+
+def load_program(binary):
+    # Validates the header of an assembled binary, then loads the program that follows it
+    if (len(binary) < PROGRAM_HEADER_SIZE or binary[:3] != PROGRAM_MAGIC or
+            binary[3] != PROGRAM_VERSION):
+        processor_msg(1, *binary[:PROGRAM_HEADER_SIZE])
+        quit()
+
+    processor_msg(4, "loading program...")
+    size = load(binary[PROGRAM_HEADER_SIZE:])
+    processor_msg(4, "loaded program of size", size)
+
+    return size
 
 
 def process_instructions(program):
+    # Loads a program without its header into RAM and runs it, returning the number of instructions executed
+    processor_msg(4, "loading program...")
+    size = load(program)
+    processor_msg(4, "loaded program of size", size)
+
+    return run()
+
+
+def run(entry_point=memory.reserved_bytes):
+    # Runs the program in RAM from entry_point, returning the number of instructions executed
     # Length, in bytes of each opcode's parameters
     opcode_parameter_lengths = [
         0,  # no-op
@@ -91,28 +408,22 @@ def process_instructions(program):
         3, 6, 9,  # jmp, jmpnul, jmpeql
         -1,  # term error
         7, 7,  # cpyblk, movblk
-        9, 9  # mod, div
+        9, 9,  # mod, div
+        0, 0,  # reti, wait
+        6,  # jmpflg
+        3, 3,  # inc, dec
+        9, 9,  # jmplt, jmpgt
+        6,  # djnz
+        3, 3,  # push, pop
+        3, 0  # call, ret
     ]
 
-    processor_msg(4, "loading program...")
-    write_address = bus.reserved_bytes  # The first 32 bytes are reserved and should not be touched
-
-    # Load each instruction/param into RAM
-    for instruction in program:
-        instruction_size = max(1, ceil(instruction.bit_length() / 8))
-        instruction_bytes = instruction.to_bytes(instruction_size, 'little')
-        bus.io(1, write_address, instruction_bytes)
-
-        write_address += instruction_size
-
-    processor_msg(4, "loaded program of size", write_address - bus.reserved_bytes)
-
     '''
         Our registers are memory mapped. This is unusual, so may be changed in the future
     '''
     # Initialize the CPU registers
     #   Special registers
-    instruction_pointer = bus.reserved_bytes
+    instruction_pointer = entry_point
     opcode = 0
     parameter_bytes = 0
     #   General-purpose registers, for modes and params
@@ -124,6 +435,17 @@ def process_instructions(program):
     reg5 = 0
     reg6 = 0
     reg7 = 0
+    instructions_executed = 0
+
+    # Programs start with clear registers and an empty stack
+    registers[:] = [0] * REGISTER_COUNT
+    bus.io(1, STACK_POINTER, STACK_TOP.to_bytes(2, "little"))
+
+    # Interrupt state
+    global interrupt_requested
+    interrupt_requested = True
+    in_handler = False
+    timer_deadline = None
 
     # Execution of the program occurs in this loop
     # it is the core of this program and handles all the processor opcodes/logic
@@ -149,60 +471,21 @@ def process_instructions(program):
         # Add
         elif opcode == 1:
             # Load parameter modes into registers
-            reg0 = bus.io(0, instruction_pointer + 1, 1)   # p1 mode
-            reg1 = bus.io(0, instruction_pointer + 2, 1)   # p2 mode
-            reg2 = bus.io(0, instruction_pointer + 3, 1)   # o mode
-
-            # Direct p1 mode
-            if reg0 == 0:
-                # Load p1 into register
-                reg3 = bus.io(0, instruction_pointer + 4, 2)  # p1
-
-            # Pointer p1 mode
-            elif reg0 == 1:
-                # Load ptr to p1 into register, then dereference into register
-                reg3 = bus.io(0, instruction_pointer + 4, 2)
-                reg3 = bus.io(0, reg3, 2)
-
-            else:
-                processor_msg(9, reg2)
-                quit()
-
-            # Direct p2 mode
-            if reg1 == 0:
-                # Load p2 into register
-                reg4 = bus.io(0, instruction_pointer + 6, 2)  # p2
-
-            # Pointer p2 mode
-            elif reg1 == 1:
-                # Load ptr to p2 into register, then deref into register
-                reg4 = bus.io(0, instruction_pointer + 6, 2)
-                reg4 = bus.io(0, reg4, 2)
-
-            else:
-                processor_msg(9, reg2)
-                quit()
-
-            # Direct output
-            if reg2 == 0:
-                # Load out addr into register
-                reg5 = bus.io(0, instruction_pointer + 8, 2)  # out
-
-            # Pointer output
-            elif reg2 == 1:
-                # Load ptr to out addr into register, then deref
-                reg5 = bus.io(0, instruction_pointer + 8, 2)
-                reg5 = bus.io(0, reg5, 2)
+            reg0 = bus.io(0, instruction_pointer + 1, 1)  # p1 mode
+            reg1 = bus.io(0, instruction_pointer + 2, 1)  # p2 mode
+            reg2 = bus.io(0, instruction_pointer + 3, 1)  # o mode
 
-            else:
-                processor_msg(10, reg2)
-                quit()
+            # Load p1 and p2 into registers
+            reg3 = read_operand(reg0, instruction_pointer + 4)  # p1
+            reg4 = read_operand(reg1, instruction_pointer + 6)  # p2
 
             # Add reg3 and reg4, store in reg6
+            # Signed overflow when both operands have a different sign to the result
             reg6 = reg3 + reg4
+            reg6 = set_flags(reg6, (reg3 ^ reg6) & (reg4 ^ reg6) & 0x8000)
 
-            # Write contents of reg6 to memory at addr reg5
-            bus.io(1, reg5, reg6)
+            # Write contents of reg6 to the output
+            write_word(reg2, instruction_pointer + 8, reg6)
 
         # Multiply
         elif opcode == 2:
@@ -211,56 +494,18 @@ def process_instructions(program):
             reg1 = bus.io(0, instruction_pointer + 2, 1)  # p2 mode
             reg2 = bus.io(0, instruction_pointer + 3, 1)  # o mode
 
-            # Direct p1 mode
-            if reg0 == 0:
-                # Load p1 into register
-                reg3 = bus.io(0, instruction_pointer + 4, 2)  # p1
-
-            # Pointer p1 mode
-            elif reg0 == 1:
-                # Load ptr to p1 into register, then dereference into register
-                reg3 = bus.io(0, instruction_pointer + 4, 2)
-                reg3 = bus.io(0, reg3, 2)
-
-            else:
-                processor_msg(9, reg2)
-                quit()
-
-            # Direct p2 mode
-            if reg1 == 0:
-                # Load p2 into register
-                reg4 = bus.io(0, instruction_pointer + 6, 2)  # p2
-
-            # Pointer p2 mode
-            elif reg1 == 1:
-                # Load ptr to p2 into register, then deref into register
-                reg4 = bus.io(0, instruction_pointer + 6, 2)
-                reg4 = bus.io(0, reg4, 2)
-
-            else:
-                processor_msg(9, reg2)
-                quit()
-
-            # Direct output
-            if reg2 == 0:
-                # Load out addr into register
-                reg5 = bus.io(0, instruction_pointer + 8, 2)  # out
-
-            # Pointer output
-            elif reg2 == 1:
-                # Load ptr to out addr into register, then deref
-                reg5 = bus.io(0, instruction_pointer + 8, 2)
-                reg5 = bus.io(0, reg5, 2)
-
-            else:
-                processor_msg(10, reg2)
-                quit()
+            # Load p1 and p2 into registers
+            reg3 = read_operand(reg0, instruction_pointer + 4)  # p1
+            reg4 = read_operand(reg1, instruction_pointer + 6)  # p2
 
             # Multiply reg3 and reg4, store in reg6
+            # Signed overflow when the signed product does not fit in 16 bits
             reg6 = reg3 * reg4
+            reg7 = to_signed(reg3) * to_signed(reg4)
+            reg6 = set_flags(reg6, reg7 < -0x8000 or reg7 > 0x7FFF)
 
-            # Write contents of reg6 to memory at addr reg5
-            bus.io(1, reg5, reg6)
+            # Write contents of reg6 to the output
+            write_word(reg2, instruction_pointer + 8, reg6)
 
         # Copy
         elif opcode == 3:
@@ -268,40 +513,11 @@ def process_instructions(program):
             reg0 = bus.io(0, instruction_pointer + 1, 1)  # i_mode
             reg1 = bus.io(0, instruction_pointer + 2, 1)  # o_mode
 
-            # Direct mode
-            if reg0 == 0:
-                # Load p1 into register
-                reg2 = bus.io(0, instruction_pointer + 3, 2)  # p1
-
-            # Pointer mode
-            elif reg0 == 1:
-                # Load ptr to p1 into register, and deref
-                reg2 = bus.io(0, instruction_pointer + 3, 2)  # a_p1
-                reg2 = bus.io(0, reg2, 2)                       # p1
-
-            else:
-                processor_msg(9, reg0)
-                quit()
-
-            # Direct output mode
-            if reg1 == 0:
-                # Load out addr into register
-                reg3 = bus.io(0, instruction_pointer + 5, 2)  # out
-                #bus.io(1, reg3, reg2)
-
-            # Pointer output mode
-            elif reg1 == 1:
-                # Load ptr to out addr into register, then deref
-                reg3 = bus.io(0, instruction_pointer + 5, 2)  # a_out
-                reg3 = bus.io(0, reg3, 2)                      # out
-                #bus.io(1, reg3, reg2)
-
-            else:
-                processor_msg(10, reg1)
-                quit()
+            # Load p1 into register
+            reg2 = read_operand(reg0, instruction_pointer + 3)  # p1
 
-            # Write the contents of reg2 into addr in reg3
-            bus.io(1, reg3, reg2)
+            # Write the contents of reg2 to the output
+            write_operand(reg1, instruction_pointer + 5, reg2)
 
         # Move
         elif opcode == 4:
@@ -310,50 +526,28 @@ def process_instructions(program):
             reg1 = bus.io(0, instruction_pointer + 2, 1)  # o_mode
 
             # Move does not have a direct mode, since there is nowhere to move a literal from!
-            # Pointer mode
-            if reg0 == 0:
-                # Load ptr to p1 into register, and deref into reg3, since we need to know the address to delete
-                reg2 = bus.io(0, instruction_pointer + 3, 2)  # a_p1
-                reg3 = bus.io(0, reg2, 2)                     # p1
+            # Register mode
+            if reg0 == MODE_REGISTER:
+                # Load the register number, and the register's contents
+                reg2 = register_number(instruction_pointer + 3)  # r_p1
+                reg3 = registers[reg2]                           # p1
 
-                #bus.io(1, reg2, 0)
-
-            # Double pointer mode
-            elif reg0 == 1:
-                # Load ptr to ptr to p1 into register, deref twice
-                reg2 = bus.io(0, instruction_pointer + 3, 2)  # aa_p1
-                reg2 = bus.io(0, reg2, 2)                     # a_p1
-                reg3 = bus.io(0, reg2, 2)                        # p1
-
-                #bus.io(1, reg2, 0)
-
-            else:
-                processor_msg(9, reg0)
-                quit()
-
-            # Direct output mode
-            if reg1 == 0:
-                # Load out addr into register
-                reg4 = bus.io(0, instruction_pointer + 5, 2)  # out
-                #bus.io(1, reg4, reg3)
-
-            # Pointer output mode
-            elif reg1 == 1:
-                # Load ptr to out addr into register and deref
-                reg4 = bus.io(0, instruction_pointer + 5, 2)  # a_out
-                reg4 = bus.io(0, reg4, 2)
-                #bus.io(1, reg4, reg3)
+                # Write the contents of reg3 to the output, then clear the register
+                write_operand(reg1, instruction_pointer + 5, reg3)
+                registers[reg2] = 0
 
             else:
-                processor_msg(10, reg1)
-                quit()
+                # Pointer mode loads ptr to p1, double pointer mode derefs it once more
+                # reg2 keeps the address, since we need to know the address to delete
+                reg2 = operand_address(reg0, instruction_pointer + 3)  # a_p1
+                reg3 = bus.io(0, reg2, 2)                              # p1
 
-            # Write the contents of reg3 to the addr in reg4
-            bus.io(1, reg4, reg3)
+                # Write the contents of reg3 to the output
+                write_operand(reg1, instruction_pointer + 5, reg3)
 
-            # Clear the contents of reg2
-            # This is the delete portion of the move instruction
-            bus.io(1, reg2, 0)
+                # Clear the contents of reg2
+                # This is the delete portion of the move instruction
+                bus.io(1, reg2, 0)
 
         # Terminate execution successfully
         elif opcode == 5:
@@ -366,22 +560,8 @@ def process_instructions(program):
             # Load input mode into register
             reg0 = bus.io(0, instruction_pointer + 1, 1)  # i_mode
 
-            # Direct mode
-            if reg0 == 0:
-                # Load p1 into register
-                reg1 = bus.io(0, instruction_pointer + 2, 2)  # p1
-                #print(reg1)
-
-            # Pointer mode
-            elif reg0 == 1:
-                # Load ptr to p1 into register, then deref
-                reg1 = bus.io(0, instruction_pointer + 2, 2)  # a_p1
-                reg1 = bus.io(0, reg1, 2)                       # p1
-                #print(reg1)
-
-            else:
-                processor_msg(9, reg0)
-                quit()
+            # Load p1 into register
+            reg1 = read_operand(reg0, instruction_pointer + 2)  # p1
 
             # Call Python print and output to console for debugging purposes
             print(reg1)
@@ -391,75 +571,37 @@ def process_instructions(program):
             # Load parameter mode into register
             reg0 = bus.io(0, instruction_pointer + 1, 1)  # jmp_mode
 
-            # Direct jump
-            if reg0 == 0 or reg0 == 2:
-                # Load jmp addr into register
-                reg1 = bus.io(0, instruction_pointer + 2, 2)  # a_jmp
-
-            # Pointer jump
-            elif reg0 == 1 or reg0 == 3:
-                # Load ptr to jmp addr into register, then deref
-                reg1 = bus.io(0, instruction_pointer + 2, 2)  # aa_jmp
-                reg1 = bus.io(0, reg1, 2)                     # a_jmp
+            # Load jmp addr into register
+            reg1 = read_target(reg0, instruction_pointer + 2)  # a_jmp
 
-            else:
-                processor_msg(9, reg0)
-                quit()
+            # Relative jump
+            if reg0 == 2 or reg0 == 3:
+                instruction_pointer += reg1
 
             # Normal jump
-            if reg0 == 0 or reg0 == 1:
+            else:
                 instruction_pointer = reg1 - parameter_bytes - 1
 
-            # Relative jump
-            elif reg0 == 2 or reg0 == 3:
-                instruction_pointer += reg1
-
         # Jump if null
         elif opcode == 8:
             # Load parameter modes into registers
             reg0 = bus.io(0, instruction_pointer + 1, 1)  # jmp_mode
             reg1 = bus.io(0, instruction_pointer + 2, 1)  # p1_mode
 
-            # Direct jump
-            if reg0 == 0 or reg0 == 2:
-                # Load jmp addr into register
-                reg2 = bus.io(0, instruction_pointer + 3, 2)  # a_jmp
-
-            # Pointer jump
-            elif reg0 == 1 or reg0 == 3:
-                # Load ptr to jmp addr into register, and deref
-                reg2 = bus.io(0, instruction_pointer + 3, 2)  # aa_jmp
-                reg2 = bus.io(0, reg2, 2)                     # a_jmp
-
-            else:
-                processor_msg(9, reg0)
-                quit()
-
-            # Literal param
-            if reg1 == 0:
-                # Load p1 into register
-                reg3 = bus.io(0, instruction_pointer + 5, 2)  # p1
-
-            # Pointer param
-            elif reg1 == 1:
-                # Load ptr to p1 into register, and deref
-                reg3 = bus.io(0, instruction_pointer + 5, 2)  # a_p1
-                reg3 = bus.io(0, reg3, 2)                       # p1
-
-            else:
-                processor_msg(9, reg1)
-                quit()
+            # Load jmp addr and p1 into registers
+            reg2 = read_target(reg0, instruction_pointer + 3)   # a_jmp
+            reg3 = read_operand(reg1, instruction_pointer + 5)  # p1
 
             # Jump if param1 is null (zero)
             if reg3 == 0:
-                # Normal jump
-                if reg0 == 0 or reg0 == 1:
-                    instruction_pointer = reg2 - parameter_bytes - 1
-
                 # Relative jump
-                elif reg0 == 2 or reg0 == 3:
+                if reg0 == 2 or reg0 == 3:
                     instruction_pointer += reg2
 
+                # Normal jump
+                else:
+                    instruction_pointer = reg2 - parameter_bytes - 1
+
         # Jump if equal
         elif opcode == 9:
             # Load parameter modes into registers
@@ -467,66 +609,28 @@ def process_instructions(program):
             reg1 = bus.io(0, instruction_pointer + 2, 1)  # p1_mode
             reg2 = bus.io(0, instruction_pointer + 3, 1)  # p2_mode
 
-            # Direct jump
-            if reg0 == 0 or reg0 == 2:
-                # Load jmp addr into register
-                reg3 = bus.io(0, instruction_pointer + 4, 2)  # a_jmp
-
-            # Pointer jump
-            elif reg0 == 1 or reg0 == 3:
-                # Load ptr to jmp addr into register and deref
-                reg3 = bus.io(0, instruction_pointer + 4, 2)  # aa_jmp
-                reg3 = bus.io(0, reg3, 2)                     # a_jmp
-
-            else:
-                processor_msg(9, reg0)
-
-            # Literal param
-            if reg1 == 0:
-                # Load p1 into register
-                reg4 = bus.io(0, instruction_pointer + 6, 2)  # p1
-
-            # Pointer param
-            elif reg1 == 1:
-                # Load ptr to p1 into register, and deref
-                reg4 = bus.io(0, instruction_pointer + 6, 2)  # aa_p1
-                reg4 = bus.io(0, reg4, 2)                       # a_p1
-
-            else:
-                processor_msg(9, reg1)
-                quit()
-
-            # Literal param
-            if reg2 == 0:
-                # Load p2 into register
-                reg5 = bus.io(0, instruction_pointer + 8, 2)  # p2
-
-            # Pointer param
-            elif reg2 == 1:
-                # Load ptr to p2 into register, then deref
-                reg5 = bus.io(0, instruction_pointer + 8, 2)  # a_p2
-                reg5 = bus.io(0, reg5, 2)                       # p2
-
-            else:
-                processor_msg(9, reg1)
-                quit()
+            # Load jmp addr, p1 and p2 into registers
+            reg3 = read_target(reg0, instruction_pointer + 4)   # a_jmp
+            reg4 = read_operand(reg1, instruction_pointer + 6)  # p1
+            reg5 = read_operand(reg2, instruction_pointer + 8)  # p2
 
             # Jump if given params are equal
             if reg4 == reg5:
+                # Relative jump
+                if reg0 == 2 or reg0 == 3:
+                    instruction_pointer += reg3
+
                 # Normal jump
-                if reg0 == 0 or reg0 == 1:
+                else:
                     instruction_pointer = reg3 - parameter_bytes - 1
 
-                elif reg0 == 2 or reg0 == 3:
-                    instruction_pointer += reg3
-
         # Terminate with error
         elif opcode == 10:
             processor_msg(11)
             opcode = 5
 
-        # Copy block
-        elif opcode == 11:
+        # Copy block and move block
+        elif opcode == 11 or opcode == 12:
             # Load parameter modes into registers
             reg0 = bus.io(0, instruction_pointer + 1, 1)  # i_mode
             reg1 = bus.io(0, instruction_pointer + 2, 1)  # o_mode
@@ -534,166 +638,232 @@ def process_instructions(program):
             # Load size parameter into register
             reg2 = bus.io(0, instruction_pointer + 3, 1)  # size
 
-            # Direct mode
-            if reg0 == 0:
-                # Load ptr to p1 into register and deref
-                reg3 = bus.io(0, instruction_pointer + 4, 2)  # a_p1
-                reg3 = bus.io(0, reg3, reg2)                    # p1
+            # Load the block addresses into registers
+            # A direct address is the block itself, a pointer holds the address of the block
+            reg3 = operand_address(reg0, instruction_pointer + 4)  # a_p1
+            reg4 = operand_address(reg1, instruction_pointer + 6)  # out
 
-            # Pointer mode
-            elif reg0 == 1:
-                # Load ptr to ptr to p1 into register and deref twice
-                reg3 = bus.io(0, instruction_pointer + 4, 2)  # aa_p1
-                reg3 = bus.io(0, reg3, 2)                     # a_p1
-                reg3 = bus.io(0, reg3, reg2)                  # p1
+            # Copy the block byte for byte, zeroes included
+            if opcode == 11:
+                bus.copy(reg3, reg4, reg2)
 
+            # Moving also clears the source block
             else:
-                processor_msg(9, reg0)
-                quit()
+                bus.move(reg3, reg4, reg2)
 
-            # Direct output mode
-            if reg1 == 0:
-                # Load out addr into register
-                reg4 = bus.io(0, instruction_pointer + 6, 2)  # out
+        # Modulo
+        elif opcode == 13:
+            # Load parameter modes into registers
+            reg0 = bus.io(0, instruction_pointer + 1, 1)  # p1 mode
+            reg1 = bus.io(0, instruction_pointer + 2, 1)  # p2 mode
+            reg2 = bus.io(0, instruction_pointer + 3, 1)  # o mode
 
-            # Pointer output mode
-            elif reg1 == 1:
-                # Load ptr to out addr into register and deref
-                reg4 = bus.io(0, instruction_pointer + 6, 2)  # a_out
-                reg4 = bus.io(0, reg4, 2)                     # out
+            # Load p1 and p2 into registers
+            reg3 = read_operand(reg0, instruction_pointer + 4)  # p1
+            reg4 = read_operand(reg1, instruction_pointer + 6)  # p2
 
+            # Modulo reg3 and reg4, store in reg6
+            # Dividing by zero gives zero, and sets the overflow flag
+            if reg4 == 0:
+                reg6 = set_flags(0, True)
             else:
-                processor_msg(10, reg1)
-                quit()
-
-            # Write contents of reg3 into addr in reg4
-            # This is slightly cheating since reg3 currently contains a block of memory, not a value
-            # TODO: de-magic the CPYBLK instruction
-            bus.io(1, reg4, reg3)
+                reg6 = set_flags(reg3 % reg4, False)
 
-        # Move block
-        elif opcode == 12:
-            print("MOVEBLK UNIMPLEMENTED")
-            pass
+            # Write contents of reg6 to the output
+            write_word(reg2, instruction_pointer + 8, reg6)
 
-        # Modulo
-        elif opcode == 13:
+        # Division
+        elif opcode == 14:
             # Load parameter modes into registers
             reg0 = bus.io(0, instruction_pointer + 1, 1)  # p1 mode
             reg1 = bus.io(0, instruction_pointer + 2, 1)  # p2 mode
             reg2 = bus.io(0, instruction_pointer + 3, 1)  # o mode
 
-            # Direct p1 mode
-            if reg0 == 0:
-                # Load p1 into register
-                reg3 = bus.io(0, instruction_pointer + 4, 2)  # p1
-
-            # Pointer p1 mode
-            elif reg0 == 1:
-                # Load ptr to p1 into register, then dereference into register
-                reg3 = bus.io(0, instruction_pointer + 4, 2)
-                reg3 = bus.io(0, reg3, 2)
+            # Load p1 and p2 into registers
+            reg3 = read_operand(reg0, instruction_pointer + 4)  # p1
+            reg4 = read_operand(reg1, instruction_pointer + 6)  # p2
 
+            # Divide reg3 and reg4, store in reg6
+            # Dividing by zero gives zero, and sets the overflow flag
+            if reg4 == 0:
+                reg6 = set_flags(0, True)
             else:
-                processor_msg(9, reg2)
-                quit()
+                reg6 = set_flags(reg3 // reg4, False)
 
-            # Direct p2 mode
-            if reg1 == 0:
-                # Load p2 into register
-                reg4 = bus.io(0, instruction_pointer + 6, 2)  # p2
+            # Write contents of reg6 to the output
+            write_word(reg2, instruction_pointer + 8, reg6)
+
+        # Jump if flags
+        elif opcode == 17:
+            # Load parameter modes into registers
+            reg0 = bus.io(0, instruction_pointer + 1, 1)  # jmp_mode
+            reg1 = bus.io(0, instruction_pointer + 2, 1)  # p1_mode
 
-            # Pointer p2 mode
-            elif reg1 == 1:
-                # Load ptr to p2 into register, then deref into register
-                reg4 = bus.io(0, instruction_pointer + 6, 2)
-                reg4 = bus.io(0, reg4, 2)
+            # Load jmp addr and flag mask into registers
+            reg2 = read_target(reg0, instruction_pointer + 3)   # a_jmp
+            reg3 = read_operand(reg1, instruction_pointer + 5)  # p1
 
-            else:
-                processor_msg(9, reg2)
-                quit()
+            # Jump if any of the flags in the mask are set
+            if bus.io(0, FLAGS, 1) & reg3:
+                # Relative jump
+                if reg0 == 2 or reg0 == 3:
+                    instruction_pointer += reg2
 
-            # Direct output
-            if reg2 == 0:
-                # Load out addr into register
-                reg5 = bus.io(0, instruction_pointer + 8, 2)  # out
+                # Normal jump
+                else:
+                    instruction_pointer = reg2 - parameter_bytes - 1
 
-            # Pointer output
-            elif reg2 == 1:
-                # Load ptr to out addr into register, then deref
-                reg5 = bus.io(0, instruction_pointer + 8, 2)
-                reg5 = bus.io(0, reg5, 2)
+        # Increment and decrement
+        elif opcode == 18 or opcode == 19:
+            # Load parameter mode into register
+            reg0 = bus.io(0, instruction_pointer + 1, 1)  # o_mode
 
+            # Load the current value of the output into register
+            reg1 = read_output(reg0, instruction_pointer + 2)  # out
+
+            # Step reg1 by one, store in reg6
+            # Signed overflow when stepping past 0x7FFF or 0x8000
+            if opcode == 18:
+                reg6 = set_flags(reg1 + 1, reg1 == 0x7FFF)
             else:
-                processor_msg(10, reg2)
-                quit()
+                reg6 = set_flags(reg1 - 1, reg1 == 0x8000)
 
-            # Modulo reg3 and reg4, store in reg6
-            reg6 = reg3 % reg4
+            # Write contents of reg6 back to the output
+            write_word(reg0, instruction_pointer + 2, reg6)
 
-            # Write contents of reg6 to memory at addr reg5
-            bus.io(1, reg5, reg6)
+        # Jump if less and jump if greater
+        elif opcode == 20 or opcode == 21:
+            # Load parameter modes into registers
+            reg0 = bus.io(0, instruction_pointer + 1, 1)  # jmp_mode
+            reg1 = bus.io(0, instruction_pointer + 2, 1)  # p1_mode
+            reg2 = bus.io(0, instruction_pointer + 3, 1)  # p2_mode
 
-        # Division
-        elif opcode == 14:
+            # Load jmp addr, p1 and p2 into registers
+            reg3 = read_target(reg0, instruction_pointer + 4)   # a_jmp
+            reg4 = read_operand(reg1, instruction_pointer + 6)  # p1
+            reg5 = read_operand(reg2, instruction_pointer + 8)  # p2
+
+            # Jump if p1 is less (or greater) than p2
+            if (reg4 < reg5) if opcode == 20 else (reg4 > reg5):
+                # Relative jump
+                if reg0 == 2 or reg0 == 3:
+                    instruction_pointer += reg3
+
+                # Normal jump
+                else:
+                    instruction_pointer = reg3 - parameter_bytes - 1
+
+        # Decrement and jump if not zero
+        elif opcode == 22:
             # Load parameter modes into registers
-            reg0 = bus.io(0, instruction_pointer + 1, 1)  # p1 mode
-            reg1 = bus.io(0, instruction_pointer + 2, 1)  # p2 mode
-            reg2 = bus.io(0, instruction_pointer + 3, 1)  # o mode
+            reg0 = bus.io(0, instruction_pointer + 1, 1)  # jmp_mode
+            reg1 = bus.io(0, instruction_pointer + 2, 1)  # o_mode
 
-            # Direct p1 mode
-            if reg0 == 0:
-                # Load p1 into register
-                reg3 = bus.io(0, instruction_pointer + 4, 2)  # p1
+            # Load jmp addr and the counter into registers
+            reg2 = read_target(reg0, instruction_pointer + 3)  # a_jmp
+            reg3 = read_output(reg1, instruction_pointer + 5)  # out
 
-            # Pointer p1 mode
-            elif reg0 == 1:
-                # Load ptr to p1 into register, then dereference into register
-                reg3 = bus.io(0, instruction_pointer + 4, 2)
-                reg3 = bus.io(0, reg3, 2)
+            # Decrement the counter and write it back
+            reg6 = set_flags(reg3 - 1, reg3 == 0x8000)
+            write_word(reg1, instruction_pointer + 5, reg6)
 
-            else:
-                processor_msg(9, reg2)
-                quit()
+            # Jump while the counter has not reached zero
+            if reg6 != 0:
+                # Relative jump
+                if reg0 == 2 or reg0 == 3:
+                    instruction_pointer += reg2
 
-            # Direct p2 mode
-            if reg1 == 0:
-                # Load p2 into register
-                reg4 = bus.io(0, instruction_pointer + 6, 2)  # p2
+                # Normal jump
+                else:
+                    instruction_pointer = reg2 - parameter_bytes - 1
 
-            # Pointer p2 mode
-            elif reg1 == 1:
-                # Load ptr to p2 into register, then deref into register
-                reg4 = bus.io(0, instruction_pointer + 6, 2)
-                reg4 = bus.io(0, reg4, 2)
+        # Push
+        elif opcode == 23:
+            # Load parameter mode into register
+            reg0 = bus.io(0, instruction_pointer + 1, 1)  # i_mode
 
-            else:
-                processor_msg(9, reg2)
-                quit()
+            # Load p1 into register, and push it
+            reg1 = read_operand(reg0, instruction_pointer + 2)  # p1
+            push(reg1)
+
+        # Pop
+        elif opcode == 24:
+            # Load parameter mode into register
+            reg0 = bus.io(0, instruction_pointer + 1, 1)  # o_mode
 
-            # Direct output
-            if reg2 == 0:
-                # Load out addr into register
-                reg5 = bus.io(0, instruction_pointer + 8, 2)  # out
+            # Pop the top of the stack, and write it to the output
+            reg1 = pop()
+            write_word(reg0, instruction_pointer + 2, reg1)
 
-            # Pointer output
-            elif reg2 == 1:
-                # Load ptr to out addr into register, then deref
-                reg5 = bus.io(0, instruction_pointer + 8, 2)
-                reg5 = bus.io(0, reg5, 2)
+        # Call
+        elif opcode == 25:
+            # Load parameter mode into register
+            reg0 = bus.io(0, instruction_pointer + 1, 1)  # jmp_mode
+
+            # Load jmp addr into register
+            reg1 = read_target(reg0, instruction_pointer + 2)  # a_jmp
+
+            # Push the address of the next instruction to return to
+            push(instruction_pointer + 1 + parameter_bytes)
 
+            # Relative jump
+            if reg0 == 2 or reg0 == 3:
+                instruction_pointer += reg1
+
+            # Normal jump
             else:
-                processor_msg(10, reg2)
-                quit()
+                instruction_pointer = reg1 - parameter_bytes - 1
 
-            # Divide reg3 and reg4, store in reg6
-            reg6 = reg3 // reg4
+        # Return
+        elif opcode == 26:
+            reg0 = pop()  # a_ret
+            instruction_pointer = reg0 - parameter_bytes - 1
+
+        # Return from interrupt
+        elif opcode == 15:
+            reg0 = bus.io(0, INT_RETURN, 2)  # a_ret
+            instruction_pointer = reg0 - parameter_bytes - 1
+            in_handler = False
+            interrupt_requested = True
+
+        # Wait for interrupt
+        elif opcode == 16:
+            # Sleep instead of spinning until an enabled interrupt is pending
+            while bus.io(0, INT_MASK, 1) != 0 and next_interrupt() < 0:
+                bus.kbd.pump()
+                bus.dmac.tick()
+                timer_deadline = tick_timer(timer_deadline)
 
-            # Write contents of reg6 to memory at addr reg5
-            bus.io(1, reg5, reg6)
+                # A background transfer keeps copying at full speed
+                if not bus.dmac.busy():
+                    sleep(WAIT_SLEEP)
+
+            interrupt_requested = True
 
         else:
             processor_msg(3, opcode, "at", instruction_pointer, "[EXHAUSTED]")
             quit()
 
         instruction_pointer += 1 + parameter_bytes
+        instructions_executed += 1
+
+        # Keep queueing key presses while the program runs, so it never has to wait for the REPL
+        if instructions_executed % DEVICE_POLL_INTERVAL == 0:
+            bus.kbd.pump()
+            bus.dmac.tick()
+            timer_deadline = tick_timer(timer_deadline)
+            if bus.io(0, INT_PENDING, 1) != 0:
+                interrupt_requested = True
+
+        # Enter the handler of a pending interrupt, saving where to return to
+        if interrupt_requested and not in_handler and opcode != 5:
+            reg7 = next_interrupt()
+            if reg7 < 0:
+                interrupt_requested = False
+            else:
+                bus.io(1, INT_PENDING, bus.io(0, INT_PENDING, 1) & ~(1 << reg7))
+                bus.io(1, INT_RETURN, instruction_pointer.to_bytes(2, "little"))
+                instruction_pointer = bus.io(0, INT_VECTORS + 2 * reg7, 2)
+                in_handler = True
+
+    return instructions_executed
@@ -3,8 +3,10 @@
     In the future, I will write the operating system on the computer itself rather than in Python
 """
 import os
+import sys
+import argparse
 
-from components import bus, keyboard
+from components import bus
 from random import randint
 
 # The virtual OS uses pygame
@@ -20,12 +22,18 @@ mode_bound = bus.vid.mode_bound
 
 ram_bound = bus.mapping["vram"][0]
 
+# Firmware files live next to this script
+files_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "files")
+
 
 def os_msg(status_code, *args):
     status_messages = [
         "Booting...",
         "File not found",
-        "Bad header"
+        "Bad header",
+        "Unknown command",
+        "Machine halted by",
+        "Bad address range"
     ]
 
     if status_code not in range(0, len(status_messages)):
@@ -37,11 +45,18 @@ def os_msg(status_code, *args):
 
 
 def power_on():
+    boot()
+
+    # Start the operating system
+    await_input()
+
+
+def boot():
     # Show boot message
     os_msg(0)
 
     # Load default palette
-    default_palette = open("files/default_palette.txt", 'r').read().split('\n')
+    default_palette = open(os.path.join(files_path, "default_palette.txt"), 'r').read().split('\n')
     default_palette = [int(bs, 2) for bs in default_palette]
     default_palette_bytes = bytearray(len(default_palette))
     for i in range(len(default_palette)):
@@ -50,7 +65,7 @@ def power_on():
     bus.io(1, ram_bound + text_bound, default_palette_bytes)
 
     # Display boot image on screen
-    draw_coords = open("files/boot_img.txt", 'r').read().split('\n')
+    draw_coords = open(os.path.join(files_path, "boot_img.txt"), 'r').read().split('\n')
     test_img_bitstring = ""
     for i in range(resolution[0] * resolution[1]):
         if str(i) in draw_coords:
@@ -71,105 +86,289 @@ def power_on():
     pass
 
     # Load font
-    font = open("files/font2.bgt", 'rb').read()
+    font = open(os.path.join(files_path, "font2.bgt"), 'rb').read()
     bus.io(1, 532, font)
 
     # Enter text mode
     newmode = 1
     bus.io(1, ram_bound + palette_bound, newmode.to_bytes(1, "little"))
 
-    # Start the operating system
-    await_input()
+
+'''
+    Memory dumps
+    Ranges are given as a region name, start:end (end exclusive) or start+length,
+    with addresses in decimal or 0x-prefixed hex
+'''
+memory_regions = {
+    "ram": (0, ram_bound),
+    "gvram": (ram_bound, ram_bound + colour_bound),
+    "tvram": (ram_bound + colour_bound, ram_bound + text_bound),
+    "pal": (ram_bound + text_bound, ram_bound + palette_bound),
+    "ins": (23, 25),
+    "kbd": (bus.mapping["kbd"][0], bus.mapping["kbd"][1] + 1),
+    "dma": (bus.mapping["dma"][0], bus.mapping["dma"][1] + 1),
+    "blt": (bus.mapping["blt"][0], bus.mapping["blt"][1] + 1),
+    "con": (bus.mapping["con"][0], bus.mapping["con"][1] + 1),
+    "stk": (bus.processor.STACK_LIMIT, bus.processor.STACK_TOP),
+    "all": (0, bus.mem_size)
+}
+
+# Dumps are written this many bytes at a time, so large ranges never build one giant string
+DUMP_CHUNK = 4096
+
+
+def parse_range(text):
+    # Returns (start, end) of an address range, or None if it is invalid
+    try:
+        if text in memory_regions:
+            start, end = memory_regions[text]
+        elif ':' in text:
+            start, end = [int(a, 0) for a in text.split(':')]
+        elif '+' in text:
+            start, length = [int(a, 0) for a in text.split('+')]
+            end = start + length
+        else:
+            start = int(text, 0)
+            end = start + 1
+
+    except ValueError:
+        return None
+
+    if start < 0 or end > bus.mem_size or start >= end:
+        return None
+
+    return start, end
+
+
+def hexdump(data, start, out=sys.stdout):
+    # Writes 16 bytes per line: address, hex bytes and printable ASCII
+    printable = bytes(c if 0x20 <= c < 0x7f else 0x2e for c in range(256))
+
+    for chunk_start in range(0, len(data), DUMP_CHUNK):
+        lines = []
+        for i in range(chunk_start, min(chunk_start + DUMP_CHUNK, len(data)), 16):
+            row = bytes(data[i:i + 16])
+            lines.append("%08x  %-47s  |%s|\n" % (start + i, row.hex(' '), row.translate(printable).decode("ASCII")))
+        out.write(''.join(lines))
+
+
+def changed_runs(old, new):
+    # Yields (offset, end) of every run of bytes that differs between old and new
+    # Equal 64-byte blocks are skipped with a single comparison
+    length = min(len(old), len(new))
+    run_start = None
+    for block in range(0, length, 64):
+        if old[block:block + 64] == new[block:block + 64]:
+            if run_start is not None:
+                yield run_start, block
+                run_start = None
+            continue
+
+        for i in range(block, min(block + 64, length)):
+            if old[i] != new[i]:
+                if run_start is None:
+                    run_start = i
+            elif run_start is not None:
+                yield run_start, i
+                run_start = None
+
+    if run_start is not None:
+        yield run_start, length
+
+    # Bytes past the end of the shorter snapshot count as changed
+    if len(old) != len(new):
+        yield length, max(len(old), len(new))
+
+
+def dump_diff(old, new, start, out=sys.stdout):
+    # Writes only the runs that changed, old bytes first, and returns how many runs there were
+    runs = 0
+    for run_start, run_end in changed_runs(old, new):
+        runs += 1
+        out.write("%08x-%08x  %d bytes\n" % (start + run_start, start + run_end, run_end - run_start))
+        for marker, data in (('-', old), ('+', new)):
+            for i in range(run_start, min(run_end, len(data)), 16):
+                out.write("%s %08x  %s\n" % (marker, start + i, bytes(data[i:min(i + 16, run_end)]).hex(' ')))
+
+    out.write(str(runs) + " changed runs\n")
+    return runs
 
 
 # Very basic operating system for the virtual computer written in Python, of course
 # Eventually, I'd like to write the operating system on the machine itself
 def await_input():
     while True:
-        x = None
-        x = input("? ")
-
-        if x == "randimg":
-            rand_img = bytearray(colour_bound)
-            for i in range(len(rand_img)):
-                rand_img[i] = randint(0, 255)
-            bus.io(1, ram_bound, rand_img)
-
-        elif x == "randpal":
-            rand_p = bytearray(8)
-            for i in range(len(rand_p)):
-                rand_p[i] = randint(0, 255)
-
-            bus.io(1, ram_bound + text_bound, rand_p)
-
-        elif x == "testimg":
-            test_image = bytearray(colour_bound)
-            for i in range(len(test_image)):
-                test_image[i] = int(i * 255 / 24000)
-            bus.io(1, ram_bound, test_image)
-
-        elif x == "loadprog":
-            path = input(" path: ")
-            if not os.path.isfile(path):
-                os_msg(1)
-                quit()
-
-            prog = open(path, 'rb').read()
-            header = prog[:4]
-            if header[:3].decode("ASCII", "ignore") != "9I6":
-                os_msg(2, *header)
-                quit()
-
-            prog = prog[4:]  # Discard the 4-byte header
-            bus.processor.process_instructions(prog)
-
-        elif x == "showgvram":
-            memcpy = bus.io(2, ram_bound, colour_bound-ram_bound)
-            print(*memcpy)
-
-        elif x == "showtvram":
-            memcpy = bus.io(2, colour_bound+ram_bound, text_bound-colour_bound)
-            print(*memcpy)
-
-        elif x == "showram":
-            memcpy = bus.io(2, 0, ram_bound)
-            print(*memcpy)
-
-        elif x == "showins":
-            memcpy = bus.io(2, 23, 2)
-            print(*memcpy)
-
-        elif x == "showpal":
-            memcpy = bus.io(2, palette_bound-8+ram_bound, 8)
-            print(*memcpy)
-
-        elif x == "textmode":
-            # Set mode byte
-            newmode = 1
-            bus.io(1, ram_bound + palette_bound, newmode.to_bytes(1, "little"))
-
-        elif x == "graphicsmode":
-            newmode = 0
-            bus.io(1, ram_bound + palette_bound, newmode.to_bytes(1, "little"))
-
-        elif x == "loadfont":
-            # Load font into RAM
-            font = open("files/font2.bgt", 'rb').read()
-            bus.io(1, 532, font)
-
-        elif x == "clearram":
-            # Clear program memory, but not the first 32 bytes of ram, or VRAM
-            bus.io(1, 32, bytes(999-32))
-
-        elif x == "quit":
-            quit()
+        x = input("? ").split()
+        if len(x) == 0:
+            x = [""]
 
+        status = run_command(x[0], x[1:])
+
+        # A missing file ends the session
+        if status == 1:
+            quit()
+        elif status == 5:
+            os_msg(5)
+
+        refresh()
+
+
+def region_size(name):
+    # (start, size) of a named memory region
+    start, end = memory_regions[name]
+    return start, end - start
+
+
+def run_command(x, args=()):
+    # Runs one operating system command, returning its status code
+    # 0 if it succeeded, otherwise the os_msg code of the failure
+    # Commands that take a path prompt for it when it is not given in args
+    if x == "randimg":
+        rand_img = bytearray(colour_bound)
+        for i in range(len(rand_img)):
+            rand_img[i] = randint(0, 255)
+        bus.io(1, ram_bound, rand_img)
+
+    elif x == "randpal":
+        rand_p = bytearray(8)
+        for i in range(len(rand_p)):
+            rand_p[i] = randint(0, 255)
+
+        bus.io(1, ram_bound + text_bound, rand_p)
+
+    elif x == "testimg":
+        test_image = bytearray(colour_bound)
+        for i in range(len(test_image)):
+            test_image[i] = int(i * 255 / 24000)
+        bus.io(1, ram_bound, test_image)
+
+    elif x == "loadprog":
+        path = args[0] if len(args) > 0 else input(" path: ")
+        if not os.path.isfile(path):
+            os_msg(1, path)
+            return 1
+
+        # The processor checks the header, and loads the program in one go
+        bus.processor.load_program(open(path, 'rb').read())
+        bus.processor.run()
+
+    elif x == "screenshot":
+        path = args[0] if len(args) > 0 else input(" path: ")
+        bus.vid.screenshot(path)
+
+    elif x == "showgvram":
+        hexdump(bus.io(2, *region_size("gvram")), memory_regions["gvram"][0])
+
+    elif x == "showtvram":
+        hexdump(bus.io(2, *region_size("tvram")), memory_regions["tvram"][0])
+
+    elif x == "showram":
+        hexdump(bus.io(2, *region_size("ram")), memory_regions["ram"][0])
+
+    elif x == "showins":
+        hexdump(bus.io(2, *region_size("ins")), memory_regions["ins"][0])
+
+    elif x == "showpal":
+        hexdump(bus.io(2, *region_size("pal")), memory_regions["pal"][0])
+
+    elif x == "dump":
+        # dump <range> [file]
+        # Writes the range as a hexdump, or as raw bytes to file
+        address_range = parse_range(args[0] if len(args) > 0 else input(" range: "))
+        if address_range is None:
+            return 5
+
+        data = bus.io(2, address_range[0], address_range[1] - address_range[0])
+        if len(args) > 1:
+            out_file = open(args[1], 'wb')
+            out_file.write(data)
+            out_file.close()
         else:
-            pass
-            #print("unknown command")
+            hexdump(data, address_range[0])
+
+    elif x == "diff":
+        # diff <snapshot> <snapshot>, or diff <snapshot> <range> to compare against memory
+        # Snapshots are raw dumps
+        old_path = args[0] if len(args) > 0 else input(" snapshot: ")
+        other = args[1] if len(args) > 1 else input(" snapshot or range: ")
+        if not os.path.isfile(old_path):
+            os_msg(1, old_path)
+            return 1
+
+        old = open(old_path, 'rb').read()
+        if os.path.isfile(other):
+            dump_diff(old, open(other, 'rb').read(), 0)
+        else:
+            address_range = parse_range(other)
+            if address_range is None:
+                return 5
+            dump_diff(old, bus.io(2, address_range[0], address_range[1] - address_range[0]), address_range[0])
+
+    elif x == "textmode":
+        # Set mode byte
+        newmode = 1
+        bus.io(1, ram_bound + palette_bound, newmode.to_bytes(1, "little"))
+
+    elif x == "graphicsmode":
+        newmode = 0
+        bus.io(1, ram_bound + palette_bound, newmode.to_bytes(1, "little"))
+
+    elif x == "loadfont":
+        # Load font into RAM
+        font = open(os.path.join(files_path, "font2.bgt"), 'rb').read()
+        bus.io(1, 532, font)
+
+    elif x == "clearram":
+        # Clear program memory, but not the first 32 bytes of ram, or VRAM
+        bus.io(1, 32, bytes(999-32))
+
+    elif x == "quit":
+        quit()
+
+    else:
+        #print("unknown command")
+        return 3
+
+    return 0
+
+
+def run_script(commands):
+    # Runs commands one after another without prompting, stopping at the first one that fails
+    # Returns the status code of the failed command, or 0
+    for line in commands:
+        x = line.split()
 
-        refresh_keyboard()
-        refresh_display()
+        # Skip blank and commented lines
+        if len(x) == 0 or x[0].startswith('#'):
+            continue
+
+        if x[0] == "quit":
+            return 0
+
+        try:
+            status = run_command(x[0], x[1:])
+
+        # The machine halts on errors, and has already said why
+        except SystemExit:
+            status = 4
+
+        if status >= 3:
+            os_msg(status, x[0])
+        if status != 0:
+            return status
+
+        refresh()
+
+    return 0
+
+
+def refresh():
+    # Nothing is shown when running headless, so only refresh to record frames
+    if bus.vid.headless and bus.vid.record_dir is None:
+        return
+
+    refresh_keyboard()
+    refresh_display()
 
 
 def refresh_display():
@@ -178,11 +377,52 @@ def refresh_display():
     bus.vid.refresh()
 
 def refresh_keyboard():
-    # Handle inputs using the virtual keyboard driver
-    pygame_events = pygame.event.get()
-    for e in pygame_events:
-        if e.type == pygame.KEYDOWN:
-            keyboard.parse_keys(e)
+    # There is no window to receive events from when running headless
+    if bus.vid.headless:
+        return
 
+    # Handle inputs using the virtual keyboard driver
+    bus.kbd.pump()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fun Virtual Computer")
+    parser.add_argument("--headless", action="store_true",
+                        help="run without opening a window")
+    parser.add_argument("--screenshot", metavar="PATH",
+                        help="save the screen to PATH (.png, otherwise raw rgb) on exit")
+    parser.add_argument("--record", metavar="DIR",
+                        help="save refreshed frames into DIR as a numbered sequence")
+    parser.add_argument("--record-every", metavar="N", type=int, default=1,
+                        help="only record every Nth refresh")
+    parser.add_argument("--frame-format", choices=["png", "raw"], default="png",
+                        help="format of recorded frames")
+    parser.add_argument("-c", "--command", metavar="CMD", action="append", default=[],
+                        help="run CMD, such as \"loadprog prog.vce\", instead of prompting (repeatable)")
+    parser.add_argument("--script", metavar="FILE",
+                        help="run the commands in FILE, one per line, instead of prompting")
+    args = parser.parse_args()
+
+    bus.vid.headless = args.headless
+    if args.record is not None:
+        bus.vid.record(args.record, args.record_every, args.frame_format)
+
+    try:
+        # Scripted sessions exit with the status of the first failed command
+        if args.script is not None or len(args.command) > 0:
+            commands = list(args.command)
+            if args.script is not None:
+                commands += open(args.script, 'r').read().split('\n')
+
+            boot()
+            return run_script(commands)
+
+        power_on()
+    finally:
+        if args.screenshot is not None:
+            bus.vid.screenshot(args.screenshot)
+
+
+if __name__ == '__main__':
+    exit(main())
 
-power_on()
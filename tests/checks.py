@@ -0,0 +1,484 @@
+"""
+    Behaviour checks for the Fun Virtual Computer
+    Runs small, targeted checks of the assembler and devices that the golden frames in
+    regression.py can not see, such as error handling
+
+    Usage:
+        checks.py [--filter <text>]
+
+    Prints one line per check, and exits with 1 if any of them failed.
+"""
+import argparse
+import contextlib
+import gc
+import glob
+import io
+import json
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+
+tests_path = os.path.dirname(os.path.abspath(__file__))
+root_path = os.path.dirname(tests_path)
+sys.path.insert(0, root_path)
+sys.path.insert(0, os.path.join(root_path, "FVC_Assembly"))
+
+import computer_interface
+import fvcal_assembler
+import fvcal_generator
+from components import blitter, bus, console, dma
+
+'''
+    Assembler
+'''
+
+# Sources that must be rejected with an AssemblyError, and nothing else
+invalid_sources = {
+    "number_too_large": "0 COPY #70000 #300",
+    "negative_number": "0 COPY #-1 #300",
+    "indexed_base_too_large": "0 COPY #1 &70000+r0",
+    "print_keyword": "0 PRINT #FLG",
+    "print_register": "0 PRINT @r0",
+    "print_too_long": "0 PRINT '" + "A" * (fvcal_assembler.MAX_PRINT_LENGTH + 1),
+    "out_too_long": "0 OUT '" + "A" * (fvcal_assembler.MAX_OUT_LENGTH + 1),
+    "raw_jump_to_line": "0 JMP '0",
+    "string_operand": "0 COPY 'abc #300",
+    "string_before_target": "0 GTEQL 'A #1 '0",
+    "goto_address": "0 GOTO #32",
+}
+
+
+def check_invalid_source(source, code=4, cache=None):
+    try:
+        fvcal_assembler.assemble(source, cache)
+
+    except fvcal_assembler.AssemblyError as error:
+        return error.code == code, str(error)
+
+    except Exception as error:
+        return False, "raised " + type(error).__name__ + ": " + str(error)
+
+    return False, "assembled"
+
+
+def check_too_large(cache=None):
+    # Code that runs past the 16-bit address space is rejected, instead of overflowing its jump targets
+    source = "\n".join(str(i) + " ADD #1 #2 #300" for i in range(7000)) + "\n7000 PRINT 'HI\n7010 GOTO '0"
+    return check_invalid_source(source, 8, cache)
+
+
+def check_cache_with_optimization():
+    # The optimizer can not run on the incremental path, so asking for both is refused
+    try:
+        fvcal_assembler.assemble("0 COPY #1 #300", fvcal_assembler.ObjectCache(), True)
+
+    except ValueError as error:
+        return True, str(error)
+
+    return False, "assembled"
+
+
+def check_keeps_gc():
+    # Assembling in memory leaves the host's garbage collector alone
+    collected = []
+    gc.callbacks.append(lambda phase, info: collected.append(phase))
+    try:
+        fvcal_assembler.assemble("\n".join(str(i) + " COPY #1 #300" for i in range(5000)))
+
+    finally:
+        gc.callbacks.pop()
+
+    return gc.isenabled() and len(collected) > 0, str(len(collected) // 2) + " collections"
+
+
+def check_longest_print():
+    # The longest PRINT string is still copied as a single block
+    source = "0 PRINT '" + "A" * fvcal_assembler.MAX_PRINT_LENGTH + "\n10 DONE"
+    binary = fvcal_assembler.assemble(source)[0]
+    return len(binary) > fvcal_assembler.MAX_PRINT_LENGTH, str(len(binary)) + " bytes"
+
+
+def check_keywords_distinct():
+    # No two address keywords name the same address
+    addresses = {}
+    for keyword, address in fvcal_assembler.keyword_params_bytecode.items():
+        addresses.setdefault(bytes(address), []).append(keyword)
+
+    shared = [names for names in addresses.values() if len(names) > 1]
+    return len(shared) == 0, "shared " + str(shared) if shared else "all distinct"
+
+
+def check_batch_crash():
+    # A source the assembler crashes on fails on its own, and the rest of the batch is still recorded
+    work_dir = tempfile.mkdtemp()
+    try:
+        source_dir = os.path.join(work_dir, "src")
+        out_dir = os.path.join(work_dir, "out")
+        os.makedirs(source_dir)
+        open(os.path.join(source_dir, "good.txt"), 'w').write("0 COPY #1 #300\n10 DONE\n")
+        open(os.path.join(source_dir, "bad.txt"), 'wb').write(b"0 COPY #1 #300\n\xff\xfe\n")
+
+        status = fvcal_assembler.compile_batch(source_dir, out_dir)
+        manifest = json.load(open(os.path.join(out_dir, "fvcal_manifest.json"), 'r'))
+        recorded = sorted(os.path.basename(p) for p in manifest)
+
+        return status == 1 and recorded == ["good.txt"], "status " + str(status) + ", recorded " + str(recorded)
+
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def check_stale_cache():
+    # An incremental cache is reused by the same assembler, and thrown away when it was written by another one
+    work_dir = tempfile.mkdtemp()
+    try:
+        cache_path = os.path.join(work_dir, "out.vce.cache")
+        cache = fvcal_assembler.ObjectCache()
+        cache.assemble("0 COPY #1 #300\n10 DONE")
+        fvcal_assembler.save_cache(cache, cache_path)
+        reused = len(fvcal_assembler.load_cache(cache_path).objects)
+
+        objects = {line: (entry[1], b"\xff") for line, entry in cache.objects.items()}
+        stale = []
+        for stored in (objects, ("0" * 64, objects)):
+            pickle.dump(stored, open(cache_path, 'wb'))
+            stale.append(len(fvcal_assembler.load_cache(cache_path).objects))
+
+        return reused == 2 and stale == [0, 0], "reused " + str(reused) + ", stale " + str(stale)
+
+    finally:
+        shutil.rmtree(work_dir)
+
+
+'''
+    Machine
+'''
+
+
+def run_source(source, optimization=False):
+    # Runs FVCAL source on a freshly booted headless machine
+    # Returns the processor's messages, and whether the machine was halted
+    return run_binary(fvcal_assembler.assemble(source, optimization=optimization)[0])
+
+
+def run_binary(binary):
+    bus.reset()
+    bus.vid.headless = True
+    output = io.StringIO()
+    halted = False
+
+    with contextlib.redirect_stdout(output):
+        computer_interface.boot()
+        try:
+            bus.processor.load_program(binary)
+            bus.processor.run()
+
+        except SystemExit:
+            halted = True
+
+    return output.getvalue(), halted
+
+
+# Arithmetic that ends in a word at 300, with the value and flags it must leave behind
+# There is no SUB, so subtracting is adding the two's complement
+carry = bus.processor.FLAG_CARRY
+zero = bus.processor.FLAG_ZERO
+overflow = bus.processor.FLAG_OVERFLOW
+arithmetic_sources = {
+    "add": ("0 ADD #1200 #34 #300", 1234, 0),
+    "add_wrap": ("0 ADD #65535 #1 #300", 0, carry | zero),
+    "add_largest": ("0 ADD #65535 #65535 #300", 65534, carry),
+    "subtract": ("0 ADD #5 #65535 #300", 4, carry),
+    "subtract_below_zero": ("0 ADD #0 #65535 #300", 65535, 0),
+    "signed_overflow": ("0 ADD #32767 #1 #300", 32768, overflow),
+    "signed_wrap": ("0 ADD #32768 #32768 #300", 0, carry | zero | overflow),
+    "mult_wrap": ("0 MULT #256 #256 #300", 0, carry | zero | overflow),
+    "div_by_zero": ("0 DIV #7 #0 #300", 0, zero | overflow),
+    "inc_wrap": ("0 COPY #65535 #300\n10 INC #300", 0, carry | zero),
+    "dec_wrap": ("0 DEC #300", 65535, carry),
+    "dec_signed": ("0 COPY #32768 #300\n10 DEC #300", 32767, overflow),
+    "register_wrap": ("0 COPY #65535 @r0\n10 INC @r0\n20 ADD @r0 #0 #300", 0, zero),
+}
+
+
+# Programs whose jumps land on lines the optimizer removes, merges into, or folds
+jump_sources = {
+    "jump_to_noop": "0 COPY #5 #300\n10 GOTO '30\n20 COPY #1 #300\n30 COPY $400 #400\n40 ADD $300 #1 #300\n50 DONE",
+    "jump_to_noop_between_prints": "0 GOTO '20\n10 PRINT 'AB\n20 COPY $400 #400\n30 PRINT 'CD\n40 DONE",
+    "jump_to_merged_print": "0 GOTO '10\n10 PRINT 'AB\n20 PRINT 'CD\n30 DONE",
+    "jump_over_merged_prints": "0 PRINT 'AB\n10 PRINT 'CD\n20 GOTO '40\n30 PRINT 'EF\n40 DONE",
+    "jump_chain": "0 GOTO '10\n10 GOTO '30\n20 COPY #1 #300\n30 DONE",
+}
+
+
+def check_optimized_runs_same(source):
+    # The optimized program leaves the same memory behind as the plain one, from the end of the
+    # longer program through VRAM, since the programs themselves differ and large ones run into VRAM
+    binaries = [fvcal_assembler.assemble(source, optimization=optimization) for optimization in (False, True)]
+    code_end = 32 + len(binaries[0][0]) - len(fvcal_assembler.HEADER)
+    states = []
+    for optimization in (False, True):
+        run_source(source, optimization)
+        states.append(bus.io(2, code_end, bus.mapping["vram"][1] + 1 - code_end))
+
+    return states[0] == states[1], "removed " + str(binaries[1][1]["removed"]) + " lines"
+
+
+def check_jump_to_removed(source):
+    # As above, for a program that jumps to a line the optimizer changed
+    passed, detail = check_optimized_runs_same(source)
+    optimized = fvcal_assembler.assemble(source, optimization=True)[0]
+    return passed and optimized != fvcal_assembler.assemble(source)[0], detail
+
+
+def check_arithmetic(source, value, flags):
+    run_source(source + "\n1000 DONE")
+    result = bus.io(0, 300, 2)
+    result_flags = bus.io(0, bus.processor.FLAGS, 1)
+    return result == value and result_flags == flags, "result " + str(result) + ", flags " + bin(result_flags)
+
+
+# Block copies of the bytes 1 to 8 at 400, with the 16 bytes they must leave at 400
+block_start = "0 COPY #400 #300\n" + "\n".join(str(i) + " COPY #" + str(i) + " #" + str(399 + i) for i in range(1, 9))
+block_sources = {
+    "cpyblk": ("CPYBLK #4 #400 #410", [1, 2, 3, 4, 5, 6, 7, 8, 0, 0, 1, 2, 3, 4, 0, 0]),
+    "cpyblk_zeroes": ("COPY #0 #404\n101 CPYBLK #4 #402 #410", [1, 2, 3, 4, 0, 6, 7, 8, 0, 0, 3, 4, 0, 6, 0, 0]),
+    "cpyblk_overlap_forward": ("CPYBLK #6 #400 #402", [1, 2, 1, 2, 3, 4, 5, 6, 0, 0, 0, 0, 0, 0, 0, 0]),
+    "cpyblk_overlap_backward": ("CPYBLK #6 #402 #400", [3, 4, 5, 6, 7, 8, 7, 8, 0, 0, 0, 0, 0, 0, 0, 0]),
+    "movblk": ("MOVBLK #4 #400 #410", [0, 0, 0, 0, 5, 6, 7, 8, 0, 0, 1, 2, 3, 4, 0, 0]),
+    "movblk_overlap_forward": ("MOVBLK #6 #400 #402", [0, 0, 1, 2, 3, 4, 5, 6, 0, 0, 0, 0, 0, 0, 0, 0]),
+    "movblk_overlap_backward": ("MOVBLK #6 #402 #400", [3, 4, 5, 6, 7, 8, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]),
+    "movblk_pointer": ("MOVBLK #2 $300 #406", [0, 0, 3, 4, 5, 6, 1, 2, 0, 0, 0, 0, 0, 0, 0, 0]),
+}
+
+
+def check_block(source, expected):
+    run_source(block_start + "\n100 " + source + "\n1000 DONE")
+    result = list(bus.io(2, 400, 16))
+    return result == expected, str(result)
+
+
+def check_old_binary():
+    # Binaries from before CPYBLK took its operand order are refused instead of running wrongly
+    binary = bytearray(fvcal_assembler.assemble("0 COPY #1 #300\n10 DONE")[0])
+    binary[3] = 4
+    messages, halted = run_binary(binary)
+    return halted and "Bad program header" in messages, "halted" if halted else "loaded"
+
+
+# Interrupt programs, raising the DMA interrupt with an immediate one-byte transfer
+# Each handler call adds one to 302, and the program sets 300 once it is back from the handler
+interrupt_setup = "0 VECTOR #2 '500\n10 COPY #400 #DMS\n20 COPY #402 #DMD\n30 COPY #1 #DML\n"
+interrupt_handler = "\n500 ADD $302 #1 #302\n510 RETI"
+interrupt_sources = {
+    "masked": ("100 COPY #0 #IMK\n110 COPY #5 #DMC\n120 COPY #1 #300", 0, 0b100),
+    "other_masked": ("100 COPY #1 #IMK\n110 COPY #5 #DMC\n120 COPY #1 #300", 0, 0b100),
+    "taken": ("100 COPY #4 #IMK\n110 COPY #5 #DMC\n120 COPY #1 #300", 1, 0),
+    "pending_until_unmasked": ("100 COPY #0 #IMK\n110 COPY #5 #DMC\n120 COPY #4 #IMK\n130 WAIT\n140 COPY #1 #300",
+                               1, 0),
+    "wait_all_masked": ("100 COPY #0 #IMK\n110 WAIT\n120 COPY #1 #300", 0, 0),
+    # Raising the interrupt again from its handler runs the handler again after RETI, instead of inside it
+    "not_nested": ("100 COPY #4 #IMK\n110 COPY #5 #DMC\n120 COPY #1 #300", 2, 0,
+                   "\n500 ADD $302 #1 #302\n505 GTEQL $302 #2 '510\n507 COPY #5 #DMC\n510 RETI"),
+    # Writing the palette and mode registers leaves the vector table and pending interrupts alone,
+    # and the interrupt is taken at the next device poll of the loop at 150
+    "display_keywords": ("100 COPY #0 #IMK\n110 COPY #5 #DMC\n120 CPYBLK #8 #600 #PAL\n130 COPY #0 #MOD" +
+                         "\n140 COPY #4 #IMK\n145 COPY #300 #304\n150 GTDNZ #304 '150\n160 COPY #1 #300", 1, 0),
+}
+
+
+def check_interrupt(body, handled, pending, handler=interrupt_handler):
+    messages, halted = run_source(interrupt_setup + body + "\n400 DONE" + handler)
+    result = (bus.io(0, 302, 2), bus.io(0, 300, 2), bus.io(0, bus.processor.INT_PENDING, 1))
+    return not halted and result == (handled, 1, pending), "handled, back, pending " + str(result)
+
+
+def check_interrupt_return():
+    # The handler sees the address of the instruction after the one that raised the interrupt
+    source = (interrupt_setup + "100 COPY #4 #IMK\n110 COPY #5 #DMC\n120 COPY #1 #300\n400 DONE" +
+              "\n500 COPY $IRA #306\n510 RETI")
+    instructions = fvcal_assembler.tokenize(source)
+    address = fvcal_assembler.layout(instructions)["120"]
+    run_source(source)
+    saved = bus.io(0, 306, 2)
+    return saved == address and bus.io(0, 300, 2) == 1, "saved " + str(saved) + ", line 120 at " + str(address)
+
+
+def check_dma_background():
+    # A background transfer copies a chunk every tick, and raises its interrupt once it is done
+    run_source("0 DONE")
+    length = 2 * dma.CHUNK_SIZE + 100
+    data = bytes(i % 251 + 1 for i in range(length))
+    bus.io(1, 2000, data)
+
+    registers = (2000).to_bytes(2, "little") + (9000).to_bytes(2, "little") + length.to_bytes(2, "little")
+    bus.io(1, bus.dmac.base, registers + bytes([dma.CONTROL_START | dma.CONTROL_BACKGROUND | dma.CONTROL_INTERRUPT]))
+
+    ticks = 0
+    statuses = []
+    while bus.dmac.busy() and ticks < 10:
+        statuses.append(bus.io(0, bus.dmac.base + dma.STATUS, 1))
+        bus.dmac.tick()
+        ticks += 1
+
+    pending = bus.io(0, bus.processor.INT_PENDING, 1)
+    passed = (ticks == 3 and statuses == [dma.STATUS_BUSY] * 3 and bus.io(2, 9000, length) == data and
+              bus.io(0, bus.dmac.base + dma.STATUS, 1) == dma.STATUS_DONE and pending == 1 << bus.processor.IRQ_DMA)
+    return passed, str(ticks) + " ticks, pending " + bin(pending)
+
+
+def check_dma_wait():
+    # A program can start a background transfer and WAIT for its interrupt
+    source = ("0 VECTOR #2 '500\n10 COPY #4 #IMK\n20 COPY #2000 #DMS\n30 COPY #9000 #DMD\n40 COPY #3000 #DML" +
+              "\n50 COPY #7 #DMC\n60 WAIT\n70 COPY #1 #300\n400 DONE\n500 COPY $DMT #302\n510 RETI")
+    run_source(source)
+    result = (bus.io(0, 302, 1), bus.io(0, 300, 2))
+    return result == (dma.STATUS_DONE, 1), "status in handler, back " + str(result)
+
+
+def blit(command, x, y, width, height, colour=0, transparent=8, source=0):
+    # Writes every blitter register at once, the command byte first, which runs it
+    words = b"".join(value.to_bytes(2, "little") for value in (x, y, width, height, source))
+    bus.io(1, bus.blt.base, bytes([command, colour, transparent, 0]) + words)
+
+
+def pixels(x, y, width):
+    # Palette indices of width pixels of graphics VRAM, from x on row y
+    row_size = bus.vid.true_resolution[0] * 3 // 8
+    return list(blitter.unpack_pixels(bus.io(2, bus.blt.vram + y * row_size, row_size))[x:x + width])
+
+
+def check_blitter_clip():
+    # A fill past the right and bottom edges only draws what is on the screen
+    run_source("0 DONE")
+    width, height = bus.vid.true_resolution
+    text_start = bus.blt.vram + height * width * 3 // 8
+    text = bus.io(2, text_start, 100)
+
+    blit(blitter.COMMAND_FILL, width - 4, height - 3, 10, 10, colour=5)
+    corner = [pixels(width - 6, y, 6) for y in range(height - 4, height)]
+    expected = [[0] * 6] + [[0, 0, 5, 5, 5, 5]] * 3
+    wrapped = pixels(0, height - 2, 6) + pixels(0, height - 1, 6)
+    passed = corner == expected and wrapped == [0] * 12 and bus.io(2, text_start, 100) == text
+    return passed, "corner " + str(corner)
+
+
+def check_blitter_transparent():
+    # A copy skips the transparent colour, and keeps the image's row length when clipped at the right edge
+    run_source("0 DONE")
+    width = bus.vid.true_resolution[0]
+    bus.io(1, 2000, bytes([1, 2, 0, 3, 0, 4, 5, 0]))
+    bus.io(1, 2008, bytes([1, 0, 2, 3, 4, 0, 6, 7]))
+
+    blit(blitter.COMMAND_FILL, 10, 10, 4, 2, colour=7)
+    blit(blitter.COMMAND_COPY, 10, 10, 4, 2, transparent=0, source=2000)
+    blit(blitter.COMMAND_COPY, 20, 10, 4, 2, source=2000)
+    blit(blitter.COMMAND_COPY, width - 2, 10, 4, 2, source=2008)
+
+    result = [pixels(10, 10, 4), pixels(10, 11, 4), pixels(20, 10, 4), pixels(20, 11, 4),
+              pixels(width - 2, 10, 2), pixels(width - 2, 11, 2), pixels(0, 11, 2)]
+    expected = [[1, 2, 7, 3], [7, 4, 5, 7], [1, 2, 0, 3], [0, 4, 5, 0], [1, 0], [4, 0], [0, 0]]
+    return result == expected, str(result)[:60]
+
+
+def check_stack_overflow():
+    # Endless recursion stops at the stack limit, before reaching the displayed text
+    messages, halted = run_source("0 CALL '0")
+    limit = bus.processor.STACK_LIMIT
+    sp = bus.io(0, bus.processor.STACK_POINTER, 2)
+    passed = halted and "Stack overflow" in messages and sp == limit and bus.io(0, limit - 2, 2) == 0
+    return passed, "stack pointer " + str(sp)
+
+
+def check_longest_out():
+    # The longest OUT string is printed whole, and its code stays clear of the font
+    text = "A" * fvcal_assembler.MAX_OUT_LENGTH
+    source = "0 OUT '" + text + "\n10 DONE"
+    code_end = 32 + len(fvcal_assembler.assemble(source)[0])
+    run_source(source)
+    printed = bus.io(2, bus.con.text, len(text) + 1)
+    expected = bytes(fvcal_assembler.FVCTE_table[c] for c in text) + bytes(1)
+    return printed == expected and code_end < 532, "code ends at " + str(code_end)
+
+
+def check_console_full_unscrolled():
+    # A full buffer that never scrolled is cleared, and printing starts over at the top left
+    run_source("0 DONE")
+    a = fvcal_assembler.FVCTE_table['A']
+    for i in range(console.TEXT_SIZE):
+        bus.con.put(0x0e if i % 101 == 0 else a)
+    bus.con.put(a)
+
+    registers = bus.io(2, bus.con.base, console.PORT)
+    scroll = bus.io(0, console.TEXT_SCROLL, 1)
+    passed = registers == bytes((1, 0, 1, 0)) and scroll == 0 and bus.io(2, bus.con.text, 2) == bytes((a, 0))
+    return passed, "registers " + registers.hex() + ", scroll " + str(scroll)
+
+
+def check_stack_underflow():
+    messages, halted = run_source("0 PUSH #1\n10 POP #300\n20 POP #300\n30 DONE")
+    return halted and "Stack underflow" in messages, "halted" if halted else "kept running"
+
+
+checks = {"assembler.invalid." + name: (lambda source=source: check_invalid_source(source))
+          for name, source in invalid_sources.items()}
+checks["assembler.too_large"] = check_too_large
+checks["assembler.too_large_incremental"] = lambda: check_too_large(fvcal_assembler.ObjectCache())
+checks["assembler.cache_with_optimization"] = check_cache_with_optimization
+checks["assembler.keeps_gc"] = check_keeps_gc
+checks["assembler.longest_print"] = check_longest_print
+checks["assembler.batch_crash"] = check_batch_crash
+checks["assembler.keywords_distinct"] = check_keywords_distinct
+checks["assembler.stale_cache"] = check_stale_cache
+checks["console.longest_out"] = check_longest_out
+checks["console.full_unscrolled"] = check_console_full_unscrolled
+checks.update({"processor.arithmetic." + name: (lambda case=case: check_arithmetic(*case))
+               for name, case in arithmetic_sources.items()})
+checks.update({"optimizer.regression." + os.path.basename(name):
+               (lambda name=name: check_optimized_runs_same(open(name, 'r').read()))
+               for name in sorted(glob.glob(os.path.join(tests_path, "src", "*.txt")))})
+checks.update({"optimizer.generated." + mix: (lambda mix=mix: check_optimized_runs_same(
+               fvcal_generator.generate(300, mix, 0)[0]))
+               for mix in fvcal_generator.mixes})
+checks.update({"optimizer." + name: (lambda source=source: check_jump_to_removed(source))
+               for name, source in jump_sources.items()})
+checks.update({"processor.block." + name: (lambda case=case: check_block(*case))
+               for name, case in block_sources.items()})
+checks["processor.old_binary"] = check_old_binary
+checks.update({"interrupt." + name: (lambda case=case: check_interrupt(*case))
+               for name, case in interrupt_sources.items()})
+checks["interrupt.return_address"] = check_interrupt_return
+checks["dma.background"] = check_dma_background
+checks["dma.wait"] = check_dma_wait
+checks["blitter.clip"] = check_blitter_clip
+checks["blitter.transparent"] = check_blitter_transparent
+checks["processor.stack_overflow"] = check_stack_overflow
+checks["processor.stack_underflow"] = check_stack_underflow
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Behaviour checks")
+    parser.add_argument("--filter", metavar="TEXT", default="",
+                        help="only run checks whose name contains TEXT")
+    args = parser.parse_args(args)
+
+    failed = 0
+    for name, check in checks.items():
+        if args.filter not in name:
+            continue
+
+        # The machine is chatty, keep its messages out of the results
+        with contextlib.redirect_stdout(io.StringIO()):
+            passed, detail = check()
+
+        print("%-4s %-44s %s" % ("ok" if passed else "FAIL", name, detail[:60]))
+        if not passed:
+            failed += 1
+
+    return 1 if failed > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
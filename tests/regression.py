@@ -0,0 +1,136 @@
+"""
+    Golden-frame regression suite for the Fun Virtual Computer
+    Runs every program in this directory headless, then hashes the final framebuffer and text VRAM
+    and compares them against the digests stored in golden.json
+
+    Usage:
+        regression.py [--update] [--report <file>] [--baseline <report>] [--tolerance <factor>]
+
+    The report is JSON, so reports from different versions can be diffed directly.
+    Passing an older report as --baseline also fails any program that got slower than the tolerance allows.
+"""
+import argparse
+import contextlib
+import glob
+import hashlib
+import io
+import json
+import os
+import sys
+from time import perf_counter
+
+tests_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(tests_path))
+
+import computer_interface
+from components import bus
+
+golden_path = os.path.join(tests_path, "golden.json")
+
+text_start = computer_interface.ram_bound + computer_interface.colour_bound
+text_end = computer_interface.ram_bound + computer_interface.text_bound
+
+
+def run_program(path):
+    # Every program runs on a freshly booted machine
+    bus.reset()
+    bus.vid.headless = True
+
+    # The machine is chatty, keep its messages out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        computer_interface.boot()
+
+        bus.processor.load_program(open(path, 'rb').read())
+        start_time = perf_counter()
+        instructions = bus.processor.run()
+        wall_time = perf_counter() - start_time
+
+    framebuffer = bus.vid.render()
+    text_vram = bus.io(2, text_start, text_end - text_start)
+
+    return {
+        "framebuffer": hashlib.sha256(framebuffer).hexdigest(),
+        "text_vram": hashlib.sha256(text_vram).hexdigest(),
+        "instructions": instructions,
+        "wall_time": round(wall_time, 6)
+    }
+
+
+def check_program(result, golden, baseline, tolerance):
+    mismatches = []
+
+    if golden is None:
+        return "new", mismatches
+
+    for key in ("framebuffer", "text_vram", "instructions"):
+        if result[key] != golden[key]:
+            mismatches.append(key)
+
+    # Only compare timings when an older report is given, since they depend on the host
+    if baseline is not None and baseline["wall_time"] > 0:
+        result["slowdown"] = round(result["wall_time"] / baseline["wall_time"], 3)
+        if result["slowdown"] > tolerance:
+            mismatches.append("wall_time")
+
+    if len(mismatches) > 0:
+        return "fail", mismatches
+
+    return "pass", mismatches
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Golden-frame regression suite")
+    parser.add_argument("--update", action="store_true",
+                        help="store the current results as the new golden digests")
+    parser.add_argument("--report", metavar="FILE",
+                        help="write the JSON report to FILE instead of stdout")
+    parser.add_argument("--baseline", metavar="REPORT",
+                        help="an earlier report to compare wall times against")
+    parser.add_argument("--tolerance", metavar="FACTOR", type=float, default=1.5,
+                        help="largest allowed slowdown compared to the baseline")
+    args = parser.parse_args(args)
+
+    golden = {}
+    if os.path.isfile(golden_path):
+        golden = json.load(open(golden_path, 'r'))["programs"]
+
+    baseline = {}
+    if args.baseline is not None:
+        baseline = json.load(open(args.baseline, 'r'))["programs"]
+
+    report = {"programs": {}, "passed": True}
+    for path in sorted(glob.glob(os.path.join(tests_path, "*.vce"))):
+        name = os.path.basename(path)
+        result = run_program(path)
+
+        status, mismatches = check_program(result, golden.get(name), baseline.get(name), args.tolerance)
+        result["status"] = status
+        result["mismatches"] = mismatches
+        if status == "fail":
+            report["passed"] = False
+
+        report["programs"][name] = result
+
+    if args.update:
+        stored = {}
+        for name, result in report["programs"].items():
+            stored[name] = {key: result[key] for key in ("framebuffer", "text_vram", "instructions")}
+
+        out_file = open(golden_path, 'w')
+        json.dump({"programs": stored}, out_file, indent=4, sort_keys=True)
+        out_file.write('\n')
+        out_file.close()
+
+    report_json = json.dumps(report, indent=4, sort_keys=True)
+    if args.report is not None:
+        out_file = open(args.report, 'w')
+        out_file.write(report_json + '\n')
+        out_file.close()
+    else:
+        print(report_json)
+
+    return 0 if report["passed"] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))